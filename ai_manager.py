@@ -8,15 +8,24 @@ from openai import OpenAI as OpenAIClient
 import aiohttp
 import re
 import json
+try:
+    # ujson (من requirements.txt) أسرع من json القياسي في ترميز/فك طلبات HTTP
+    import ujson as fast_json
+except ImportError:
+    fast_json = json
 import base64
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta, timezone
 from enum import Enum
 from typing import Optional, List, Dict, Any, Tuple, Union
 from dataclasses import dataclass, field
 from urllib.parse import urlparse
 import hashlib
-from collections import OrderedDict
+from collections import OrderedDict, Counter
+from functools import lru_cache
 import time
+import random
+import uuid
+from email.utils import parsedate_to_datetime
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +43,117 @@ class Provider(Enum):
     LUMA = "luma"
     KLING = "kling"
 
-@dataclass
+# ==================== مصنفات الموديلات (مُجمّعة مرة واحدة) ====================
+
+# نمط واحد يصنف موديل Google (الخدمة + الإصدار + الأولوية) في مسح واحد
+# (يدعم صيغ الكتابة المختلفة . و -)
+_GOOGLE_CLASSIFIER = re.compile(
+    r'(?P<g3>gemini-3)|(?P<g25>gemini-2[.\-]5)|(?P<g20>gemini-2[.\-]0)'
+    r'|(?P<g15>gemini-1[.\-]5)|(?P<g10>gemini-(?:1[.\-]0|pro))|(?P<gemini>gemini)'
+    r'|(?P<banana>banana)|(?P<im4>imagen-4)|(?P<im3>imagen-3)|(?P<im2>imagen-2)'
+    r'|(?P<imagen>imagen)|(?P<veo>veo)'
+)
+
+# اسم المجموعة -> (نوع الخدمة، الإصدار، الأولوية)
+_GOOGLE_CLASSES = {
+    'g3': (ServiceType.CHAT, "3.0", 10),
+    'g25': (ServiceType.CHAT, "2.5", 15),
+    'g20': (ServiceType.CHAT, "2.0", 20),
+    'g15': (ServiceType.CHAT, "1.5", 30),
+    'g10': (ServiceType.CHAT, "1.0", 40),
+    'gemini': (ServiceType.CHAT, "1.0", 100),
+    'banana': (ServiceType.IMAGE, "1.0", 5),
+    'im4': (ServiceType.IMAGE, "1.0", 10),
+    'im3': (ServiceType.IMAGE, "1.0", 20),
+    'im2': (ServiceType.IMAGE, "1.0", 30),
+    'imagen': (ServiceType.IMAGE, "1.0", 50),
+    'veo': (ServiceType.VIDEO, "1.0", 10),
+}
+
+_OPENAI_CLASSIFIER = re.compile(
+    r'(?P<gpt4o>gpt-4o)|(?P<gpt4t>gpt-4-turbo)|(?P<gpt4>gpt-4)|(?P<gpt35>gpt-3\.5-turbo)'
+    r'|(?P<dalle3>dall-e-3)|(?P<dalle2>dall-e-2)'
+)
+
+# موديلات OpenAI التي لا تصلح للمحادثة/الصور رغم تشابه الاسم (صوت، بحث...)
+_OPENAI_EXCLUDED_RE = re.compile(r'audio|realtime|tts|transcribe|search')
+
+_OPENAI_CLASSES = {
+    'gpt4o': (ServiceType.CHAT, "4.0", 10),
+    'gpt4t': (ServiceType.CHAT, "4.0", 15),
+    'gpt4': (ServiceType.CHAT, "4.0", 20),
+    'gpt35': (ServiceType.CHAT, "3.5", 25),
+    'dalle3': (ServiceType.IMAGE, "3.0", 5),
+    'dalle2': (ServiceType.IMAGE, "2.0", 10),
+}
+
+@lru_cache(maxsize=4096)
+def _prompt_key(prompt: str) -> str:
+    """بصمة قصيرة للوصف (تُحفظ لتجنب إعادة الحساب للأوصاف المتكررة)"""
+    return hashlib.blake2b(prompt.encode(), digest_size=6).hexdigest()
+
+def _write_file(data: bytes, filename: str):
+    """حفظ الملف دفعة واحدة، مع حذفه إن فشلت الكتابة حتى لا تبقى صورة مقطوعة"""
+    try:
+        with open(filename, "wb") as f:
+            f.write(data)
+    except BaseException:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        raise
+
+def _decode_and_write(b64_data: str, filename: str):
+    """فك تشفير base64 وحفظ الملف (تُستدعى في thread لتجنب حجب حلقة الأحداث)"""
+    _write_file(base64.b64decode(b64_data), filename)
+
+class ProviderError(Exception):
+    """خطأ من مزود خارجي مع مهلة إعادة المحاولة التي طلبها الخادم (إن وجدت)"""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _parse_retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    """قراءة Retry-After (ثواني أو تاريخ HTTP) من ردود 429/503 فقط"""
+    if response.status not in (429, 503):
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """مهلة الانتظار قبل المحاولة التالية: ما طلبه الخادم، وإلا تراجع أسي مع jitter"""
+    if retry_after is not None:
+        return min(retry_after, 30.0)
+    return min(30.0, 0.5 * 2 ** attempt) + random.uniform(0, 0.5)
+
+# أنماط Stability المقابلة لأنماط البوت
+_STABILITY_STYLE_PRESETS = {
+    "realistic": "photographic",
+    "anime": "anime",
+    "fantasy": "fantasy-art",
+    "cyberpunk": "neon-punk",
+    "watercolor": None
+}
+
+# أنماط تصنيف أخطاء المزودين داخل حلقة الـ fallback
+_QUOTA_ERROR_RE = re.compile(r'429|quota|rate limit|resource exhausted', re.IGNORECASE)
+_MODEL_ERROR_RE = re.compile(r'404|not found|invalid model', re.IGNORECASE)
+
+# أفكار الموديل الداخلية التي تُحذف من الرد
+_THOUGHT_RE = re.compile(r'THOUGHT:.*?(?=\n\n|\Z)', re.DOTALL | re.IGNORECASE)
+
+@dataclass(slots=True)
 class ModelInfo:
     """معلومات الموديل"""
     name: str
@@ -48,23 +167,157 @@ class ModelInfo:
     priority: int = 100
     supports_enhancement: bool = True
 
-@dataclass
+@dataclass(slots=True)
 class ProviderConfig:
     """إعدادات مزود الخدمة"""
     name: Provider
     api_key: Optional[str] = None
     enabled: bool = False
     daily_limit: int = 100
+    requests_per_minute: int = 60
+    max_concurrency: int = 5
     usage_today: int = 0
     errors_today: int = 0
     avg_response_time: float = 0.0
     last_error: Optional[str] = None
     
-    # قائمة الموديلات المكتشفة
-    discovered_models: Dict[ServiceType, List[ModelInfo]] = field(default_factory=dict)
+    # قائمة الموديلات المكتشفة (مرتبة حسب الأولوية ومجمدة كـ tuple)
+    discovered_models: Dict[ServiceType, Tuple[ModelInfo, ...]] = field(default_factory=dict)
+    
+    # فهرس جانبي: اسم الموديل -> موقعه في discovered_models
+    model_index: Dict[ServiceType, Dict[str, int]] = field(default_factory=dict)
     
     # الموديل النشط الحالي
     active_models: Dict[ServiceType, str] = field(default_factory=dict)
+    
+    # موقع الموديل النشط داخل discovered_models (للتدوير بدون بحث)
+    active_model_index: Dict[ServiceType, int] = field(default_factory=dict)
+    
+    # عدد الموديلات لكل خدمة (يُحدّث عند الاكتشاف فقط، تقرؤه الإحصائيات مباشرة)
+    discovered_models_count: Dict[str, int] = field(default_factory=dict)
+    
+    def set_discovered_models(self, service_type: ServiceType, models: List[ModelInfo]):
+        """تسجيل موديلات خدمة: ترتيب حسب الأولوية + بناء الفهرس الجانبي"""
+        ordered = tuple(sorted(models, key=lambda x: x.priority))
+        self.discovered_models[service_type] = ordered
+        self.model_index[service_type] = {m.name: i for i, m in enumerate(ordered)}
+        self.discovered_models_count[service_type.value] = len(ordered)
+
+_MISSING = object()
+
+class LRUCache:
+    """
+    كاش LRU مبني على OrderedDict (مكتوبة بـ C في CPython)
+    الترقية move_to_end والطرد popitem كلاهما O(1) بدون عقد Python
+    """
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        # الترتيب: الأول = الأقدم، الأخير = الأحدث
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        data = self._data
+        value = data.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._data
+        if key in data:
+            data.move_to_end(key)
+        elif len(data) >= self.max_size:
+            data.popitem(last=False)
+        data[key] = value
+
+    def __getitem__(self, key):
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def keys(self) -> List[Any]:
+        return list(self._data.keys())
+
+    def clear(self):
+        self._data.clear()
+
+class TTLCache(LRUCache):
+    """
+    كاش LRU محدود الحجم تنتهي عناصره بعد ttl ثانية
+    العناصر المنتهية تُحذف من مقدمة الترتيب عند كل إضافة، أو عند قراءتها
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600.0):
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def _purge_expired(self, now: float):
+        data = self._data
+        while data:
+            expires_at = next(iter(data.values()))[0]
+            if expires_at > now:
+                break
+            data.popitem(last=False)
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time.monotonic():
+            del self._data[key]
+            return default
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        self._purge_expired(now)
+        super().__setitem__(key, (now + self.ttl, value))
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+class TokenBucket:
+    """
+    محدد معدل (Token Bucket) لكل مزود
+    يؤخر الطلب محلياً بدلاً من إرساله وتلقي خطأ 429
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate  # رموز في الثانية
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """انتظار رمز متاح ثم استهلاكه"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
 class SmartAIManager:
     """
@@ -75,19 +328,70 @@ class SmartAIManager:
     def __init__(self, db):
         """تهيئة المدير الذكي"""
         self.db = db
-        self.user_limits_cache = OrderedDict()
         self.max_cache_size = 1000
+        # كاش الاستخدام مقسم حسب اليوم: التاريخ -> LRU[(user_id, service_type)] -> العدد
+        self.user_limits_cache: Dict[str, LRUCache] = {}
+        # حجوزات الطلبات الجارية (لم تكتمل بعد) - تمنع تجاوز الحد بالطلبات المتزامنة
+        self._reserved_usage: Dict[str, Dict[Tuple[int, str], int]] = {}
+        
+        # الحدود اليومية تُقرأ مرة واحدة، وتاريخ اليوم يُحسب مرة واحدة لكل يوم
+        self._limits: Dict[str, int] = {
+            "ai_chat": int(os.getenv("DAILY_AI_LIMIT", "20")),
+            "image_gen": int(os.getenv("DAILY_IMAGE_LIMIT", "5")),
+            "video_gen": int(os.getenv("DAILY_VIDEO_LIMIT", "2"))
+        }
+        self._today_str = ""
+        self._day_ends_at = 0.0
+        self._today()
+        
+        # تخزين جلسات الدردشة مع وقت انتهاء (مرتبة من الأقدم نشاطاً للأحدث)
+        self.chat_sessions: OrderedDict[int, Dict[str, Any]] = OrderedDict()
+        self.session_timeout = 3600.0  # ثانية (ساعة) - يقارن مع time.monotonic()
+        self.max_chat_sessions = int(os.getenv("MAX_CHAT_SESSIONS", "10000"))
+        
+        # كاش الأوصاف المحسّنة: مفتاح blake2b -> (وقت الانتهاء، الوصف)
+        self._enhanced_prompts = LRUCache(2048)
+        self._enhance_inflight: Dict[bytes, asyncio.Task] = {}
+        # توليد صور/فيديو جارٍ لنفس الوصف (الطلبات المكررة تنتظر نفس النتيجة)
+        self._generation_inflight: Dict[bytes, asyncio.Task] = {}
+        self.enhance_cache_ttl = 3600.0
+        self.enhance_fallback_ttl = 60.0  # الوصف الاحتياطي يُعاد تجربته أسرع
         
-        # تخزين جلسات الدردشة مع وقت انتهاء
-        self.chat_sessions: Dict[int, Dict[str, Any]] = {}
-        self.session_timeout = timedelta(hours=1)
+        # مجلد التحميلات (مرة واحدة عند البدء بدلاً من كل طلب)
+        os.makedirs("downloads", exist_ok=True)
         
         # ذاكرة مؤقتة للصور والفيديوهات المولدة
-        self.generated_files_cache: Dict[str, Dict] = {}
+        # (محدودة الحجم، وتنتهي بعد يوم بما يتوافق مع الحدود اليومية)
+        self.generated_files_cache = TTLCache(max_size=10000, ttl=86400.0)
         
         # تهيئة جميع المزودين
         self.providers: Dict[Provider, ProviderConfig] = self._init_providers()
         
+        # محدد معدل لكل مزود (حسب عدد الطلبات المسموح في الدقيقة)
+        self._buckets: Dict[Provider, TokenBucket] = {
+            provider: TokenBucket(config.requests_per_minute / 60.0, config.requests_per_minute)
+            for provider, config in self.providers.items()
+        }
+        
+        # دوال التوليد لكل مزود بتوقيع موحد (model_name, prompt, style/image_url)
+        # المزود يتجاهل ما لا يحتاجه (مثلاً Stability بموديل واحد يتجاهل model_name)
+        self._image_dispatch = {
+            Provider.GOOGLE: self._generate_image_google,
+            Provider.OPENAI: self._generate_image_openai,
+            Provider.STABILITY: self._generate_image_stability
+        }
+        self._video_dispatch = {
+            Provider.GOOGLE: self._generate_video_google,
+            Provider.LUMA: self._generate_video_luma,
+            Provider.KLING: self._generate_video_kling
+        }
+        
+        # حد الطلبات المتزامنة لكل مزود (الزائد ينتظر محلياً بدل عاصفة 429 من المزود)
+        self._provider_sem: Dict[Provider, asyncio.Semaphore] = {
+            provider: asyncio.Semaphore(config.max_concurrency)
+            for provider, config in self.providers.items()
+        }
+        
         # علامة للاكتشاف
         self.discovery_completed = False
         self.discovery_lock = asyncio.Lock()
@@ -95,6 +399,23 @@ class SmartAIManager:
         # إعدادات الـ timeout الافتراضية
         self.default_timeout = aiohttp.ClientTimeout(total=30)
         
+        # مهلة انتظار المزود الأول قبل إطلاق المزود التالي بالتوازي (ثواني)
+        self.chat_hedge_delay = float(os.getenv("CHAT_HEDGE_DELAY", "4"))
+        self.image_hedge_delay = float(os.getenv("IMAGE_HEDGE_DELAY", "20"))
+        self.video_hedge_delay = float(os.getenv("VIDEO_HEDGE_DELAY", "120"))
+        
+        # جلسة HTTP مشتركة (تُنشأ عند أول استخدام لإعادة استخدام اتصالات TCP/TLS)
+        self._http: Optional[aiohttp.ClientSession] = None
+        
+        # كاتب خلفي لاستخدام المستخدمين: يجمع التحديثات ويكتبها دفعة واحدة
+        self._usage_queue: asyncio.Queue = asyncio.Queue()
+        self._usage_writer_task: Optional[asyncio.Task] = None
+        self.usage_flush_interval = 0.5  # ثانية
+        self.usage_batch_size = 100
+        
+        # مهمة خلفية تعيد تعيين العدادات اليومية عند منتصف الليل (start_daily_reset)
+        self._daily_reset_task: Optional[asyncio.Task] = None
+        
         logger.info("🚀 تم تهيئة النظام الذكي للذكاء الاصطناعي (كامل الخدمات)")
     
     def _init_providers(self) -> Dict[Provider, ProviderConfig]:
@@ -103,27 +424,37 @@ class SmartAIManager:
             Provider.GOOGLE: ProviderConfig(
                 name=Provider.GOOGLE,
                 api_key=os.getenv("GOOGLE_AI_API_KEY"),
-                daily_limit=int(os.getenv("GOOGLE_DAILY_LIMIT", "50"))  # تقليل القيمة الافتراضية
+                daily_limit=int(os.getenv("GOOGLE_DAILY_LIMIT", "50")),  # تقليل القيمة الافتراضية
+                requests_per_minute=int(os.getenv("GOOGLE_RPM", "15")),
+                max_concurrency=int(os.getenv("GOOGLE_CONCURRENCY", "10"))
             ),
             Provider.OPENAI: ProviderConfig(
                 name=Provider.OPENAI,
                 api_key=os.getenv("OPENAI_API_KEY"),
-                daily_limit=int(os.getenv("OPENAI_DAILY_LIMIT", "30"))
+                daily_limit=int(os.getenv("OPENAI_DAILY_LIMIT", "30")),
+                requests_per_minute=int(os.getenv("OPENAI_RPM", "60")),
+                max_concurrency=int(os.getenv("OPENAI_CONCURRENCY", "5"))
             ),
             Provider.STABILITY: ProviderConfig(
                 name=Provider.STABILITY,
                 api_key=os.getenv("STABILITY_API_KEY"),
-                daily_limit=int(os.getenv("STABILITY_DAILY_LIMIT", "20"))
+                daily_limit=int(os.getenv("STABILITY_DAILY_LIMIT", "20")),
+                requests_per_minute=int(os.getenv("STABILITY_RPM", "10")),
+                max_concurrency=int(os.getenv("STABILITY_CONCURRENCY", "3"))
             ),
             Provider.LUMA: ProviderConfig(
                 name=Provider.LUMA,
                 api_key=os.getenv("LUMAAI_API_KEY"),
-                daily_limit=int(os.getenv("LUMA_DAILY_LIMIT", "10"))
+                daily_limit=int(os.getenv("LUMA_DAILY_LIMIT", "10")),
+                requests_per_minute=int(os.getenv("LUMA_RPM", "5")),
+                max_concurrency=int(os.getenv("LUMA_CONCURRENCY", "2"))
             ),
             Provider.KLING: ProviderConfig(
                 name=Provider.KLING,
                 api_key=os.getenv("KLING_API_KEY"),
-                daily_limit=int(os.getenv("KLING_DAILY_LIMIT", "5"))
+                daily_limit=int(os.getenv("KLING_DAILY_LIMIT", "5")),
+                requests_per_minute=int(os.getenv("KLING_RPM", "5")),
+                max_concurrency=int(os.getenv("KLING_CONCURRENCY", "2"))
             )
         }
         
@@ -136,8 +467,66 @@ class SmartAIManager:
                 config.enabled = False
                 logger.warning(f"⚠️ {provider_name.value}: مفتاح API غير صالح (قصير جداً)")
         
+        # المزودون الداعمون لكل خدمة (يُحسب مرة واحدة بدلاً من كل طلب)
+        self._providers_by_service: Dict[ServiceType, Tuple[ProviderConfig, ...]] = {
+            ServiceType.CHAT: (providers[Provider.GOOGLE], providers[Provider.OPENAI]),
+            ServiceType.IMAGE: (providers[Provider.GOOGLE], providers[Provider.OPENAI], providers[Provider.STABILITY]),
+            ServiceType.VIDEO: (providers[Provider.GOOGLE], providers[Provider.LUMA], providers[Provider.KLING])
+        }
+        
         return providers
     
+    async def _get_http(self) -> aiohttp.ClientSession:
+        """الحصول على جلسة HTTP المشتركة"""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                timeout=self.default_timeout,
+                json_serialize=fast_json.dumps,
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=20,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=60
+                )
+            )
+        return self._http
+    
+    def start_daily_reset(self):
+        """تشغيل مهمة إعادة التعيين اليومية (تُستدعى مرة عند بدء البوت)"""
+        if self._daily_reset_task is None or self._daily_reset_task.done():
+            self._daily_reset_task = asyncio.create_task(self._daily_reset_loop())
+    
+    async def _daily_reset_loop(self):
+        """انتظار منتصف الليل (توقيت الخادم) ثم إعادة تعيين العدادات اليومية"""
+        while True:
+            await asyncio.sleep(max(1.0, self._day_ends_at - time.time()))
+            self._today()
+            self.reset_daily_counts()
+    
+    async def close(self):
+        """إغلاق جلسة HTTP المشتركة وتفريغ تحديثات الاستخدام المتبقية"""
+        if self._daily_reset_task is not None:
+            self._daily_reset_task.cancel()
+            self._daily_reset_task = None
+        
+        # None إشارة توقف للكاتب (الإلغاء قد يضيع داخل wait_for في Python 3.11)
+        if self._usage_writer_task is not None and not self._usage_writer_task.done():
+            self._usage_queue.put_nowait(None)
+            await self._usage_writer_task
+        self._usage_writer_task = None
+        
+        remaining = []
+        while not self._usage_queue.empty():
+            item = self._usage_queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        if remaining:
+            await asyncio.to_thread(self._flush_usage, remaining)
+        
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        self._http = None
+    
     async def ensure_discovery(self):
         """التأكد من أن الاكتشاف تم"""
         if not self.discovery_completed:
@@ -151,14 +540,18 @@ class SmartAIManager:
         try:
             logger.info("🔍 بدء اكتشاف الموديلات تلقائياً...")
             
-            # 1. إعداد Google API واكتشاف موديلاته
-            await self._setup_and_discover_google()
-            
-            # 2. إعداد OpenAI API واكتشاف موديلاته
-            await self._setup_and_discover_openai()
+            # 1-3. إعداد جميع المزودين بالتوازي (Google + OpenAI + باقي APIs)
+            # فشل مزود واحد لا يوقف اكتشاف الباقين
+            setup_steps = {
+                "google": self._setup_and_discover_google(),
+                "openai": self._setup_and_discover_openai(),
+                "other_apis": self._setup_other_apis()
+            }
+            results = await asyncio.gather(*setup_steps.values(), return_exceptions=True)
             
-            # 3. إعداد باقي APIs
-            await self._setup_other_apis()
+            for step_name, result in zip(setup_steps, results):
+                if isinstance(result, Exception):
+                    logger.error(f"❌ فشل إعداد {step_name}: {result}", exc_info=result)
             
             # 4. تسجيل النتائج
             self._log_discovery_results()
@@ -184,8 +577,8 @@ class SmartAIManager:
             if not google_config.api_key.startswith("AI"):
                 logger.warning("⚠️ Google API Key لا يبدو بصيغة صحيحة")
             
-            # إعداد API
-            genai.configure(api_key=google_config.api_key)
+            # إعداد API (خارج حلقة الأحداث حتى لا تتعطل باقي الطلبات)
+            await asyncio.to_thread(genai.configure, api_key=google_config.api_key)
             google_config.enabled = True
             
             # اكتشاف جميع الموديلات المتاحة
@@ -206,7 +599,7 @@ class SmartAIManager:
                 'veo-3.0-generate-001'
             ]
             
-            google_config.discovered_models = {
+            found_models = {
                 ServiceType.CHAT: [],
                 ServiceType.IMAGE: [],
                 ServiceType.VIDEO: []
@@ -215,20 +608,18 @@ class SmartAIManager:
             for model_name in prioritized_models:
                 model_info = self._analyze_google_model(model_name)
                 if model_info:
-                    google_config.discovered_models[model_info.service_type].append(model_info)
+                    found_models[model_info.service_type].append(model_info)
             
             # ترتيب الموديلات حسب الأولوية (الأقل أولوية = الأفضل)
-            for service_type in google_config.discovered_models:
-                google_config.discovered_models[service_type].sort(
-                    key=lambda x: x.priority,
-                    reverse=False 
-                )
+            for service_type, models in found_models.items():
+                google_config.set_discovered_models(service_type, models)
                 
             # طباعة الموديل المختار للتأكد
             if google_config.discovered_models[ServiceType.CHAT]:
                 top_model = google_config.discovered_models[ServiceType.CHAT][0]
                 logger.info(f"👑 تم اختيار موديل القمة: {top_model.name} (Priority: {top_model.priority})")
                 google_config.active_models[ServiceType.CHAT] = top_model.name
+                google_config.active_model_index[ServiceType.CHAT] = 0
             
         except Exception as e:
             logger.error(f"❌ فشل إعداد Google: {e}", exc_info=True)
@@ -236,71 +627,24 @@ class SmartAIManager:
 
     def _analyze_google_model(self, model_name: str) -> Optional[ModelInfo]:
         """تحليل موديل Google (يدعم صيغ الكتابة المختلفة . و -)"""
-        try:
-            model_lower = model_name.lower()
-            
-            # السماح بجميع الموديلات
-            
-            # تصنيف الخدمة
-            if 'gemini' in model_lower and 'tts' not in model_lower:
-                service_type = ServiceType.CHAT
-            elif 'imagen' in model_lower or 'banana' in model_lower:
-                service_type = ServiceType.IMAGE
-            elif 'veo' in model_lower:
-                service_type = ServiceType.VIDEO
-            else:
-                return None
-            
-            # ====================================================
-            # ⚡️ نظام الأولويات (مع دعم النقطة والشرطة) ⚡️
-            # ====================================================
-            version = "1.0"
-            priority = 100 
-            
-            if service_type == ServiceType.CHAT:
-                # 1. Gemini 3.0 (يلتقط 3.0 و 3-0 و 3 فقط)
-                if 'gemini-3' in model_lower:
-                    version = "3.0"
-                    priority = 10 
-                
-                # 2. Gemini 2.5 (يلتقط 2.5 و 2-5)
-                elif 'gemini-2.5' in model_lower or 'gemini-2-5' in model_lower:
-                    version = "2.5"
-                    priority = 15
-                
-                # 3. Gemini 2.0 (يلتقط 2.0 و 2-0)
-                elif 'gemini-2.0' in model_lower or 'gemini-2-0' in model_lower:
-                    version = "2.0"
-                    priority = 20
-                
-                # 4. Gemini 1.5 (يلتقط 1.5 و 1-5)
-                elif 'gemini-1.5' in model_lower or 'gemini-1-5' in model_lower:
-                    version = "1.5"
-                    priority = 30
-                
-                # 5. Gemini 1.0
-                elif 'gemini-1.0' in model_lower or 'gemini-1-0' in model_lower or 'gemini-pro' in model_lower:
-                    version = "1.0"
-                    priority = 40
-                
-            elif service_type == ServiceType.IMAGE:
-                # ترتيب الصور
-                if 'banana' in model_lower:      priority = 5
-                elif 'imagen-4' in model_lower:  priority = 10
-                elif 'imagen-3' in model_lower:  priority = 20
-                elif 'imagen-2' in model_lower:  priority = 30
-                else: priority = 50
-                
-            elif service_type == ServiceType.VIDEO:
-                if 'veo' in model_lower: priority = 10
-            
-            return ModelInfo(
-                name=model_name, provider=Provider.GOOGLE, service_type=service_type, 
-                version=version, is_latest=('latest' in model_lower), priority=priority
-            )
-            
-        except: return None
-    
+        model_lower = model_name.lower()
+        
+        # تصنيف الخدمة والإصدار والأولوية في مسح واحد
+        match = _GOOGLE_CLASSIFIER.search(model_lower)
+        if not match:
+            return None
+        
+        service_type, version, priority = _GOOGLE_CLASSES[match.lastgroup]
+        
+        # موديلات تحويل النص لصوت ليست للمحادثة
+        if service_type == ServiceType.CHAT and 'tts' in model_lower:
+            return None
+        
+        return ModelInfo(
+            name=model_name, provider=Provider.GOOGLE, service_type=service_type, 
+            version=version, is_latest=('latest' in model_lower), priority=priority
+        )
+        
     async def _setup_and_discover_openai(self):
         """إعداد OpenAI API واكتشاف موديلاته"""
         openai_config = self.providers[Provider.OPENAI]
@@ -319,13 +663,13 @@ class SmartAIManager:
             
             logger.info("🔍 جاري اكتشاف موديلات OpenAI...")
             
-            openai_config.discovered_models = {
+            found_models = {
                 ServiceType.CHAT: [],
                 ServiceType.IMAGE: [],
                 ServiceType.VIDEO: []
             }
             
-            # قائمة الموديلات المعروفة
+            # قائمة الموديلات المعروفة (احتياطية إذا فشل جلب القائمة من API)
             known_openai_models = {
                 ServiceType.CHAT: [
                     'gpt-4o', 'gpt-4o-mini', 'gpt-4-turbo', 'gpt-4', 
@@ -336,16 +680,32 @@ class SmartAIManager:
                 ]
             }
             
-            # اختبار كل موديل
-            for service_type, models in known_openai_models.items():
-                for model_name in models:
-                    model_info = self._analyze_openai_model(model_name, service_type)
-                    if model_info:
-                        openai_config.discovered_models[service_type].append(model_info)
+            # جلب الموديلات المتاحة فعلياً لهذا المفتاح في طلب واحد
+            try:
+                api_models = await asyncio.to_thread(lambda: list(self.openai_client.models.list()))
+                for api_model in api_models:
+                    model_lower = api_model.id.lower()
+                    if _OPENAI_EXCLUDED_RE.search(model_lower):
+                        continue
+                    
+                    match = _OPENAI_CLASSIFIER.search(model_lower)
+                    if match:
+                        service_type = _OPENAI_CLASSES[match.lastgroup][0]
+                        found_models[service_type].append(self._analyze_openai_model(api_model.id, service_type))
+            except Exception as e:
+                logger.warning(f"⚠️ فشل جلب قائمة موديلات OpenAI، استخدام القائمة المعروفة: {e}")
+            
+            # اختبار كل موديل من القائمة المعروفة (فقط إذا لم يُرجع API شيئاً)
+            if not any(found_models.values()):
+                for service_type, models in known_openai_models.items():
+                    for model_name in models:
+                        model_info = self._analyze_openai_model(model_name, service_type)
+                        if model_info:
+                            found_models[service_type].append(model_info)
             
             # ترتيب الموديلات
-            for service_type in openai_config.discovered_models:
-                openai_config.discovered_models[service_type].sort(key=lambda x: x.priority)
+            for service_type, models in found_models.items():
+                openai_config.set_discovered_models(service_type, models)
             
         except Exception as e:
             logger.error(f"❌ فشل إعداد OpenAI: {e}", exc_info=True)
@@ -353,50 +713,30 @@ class SmartAIManager:
     
     def _analyze_openai_model(self, model_name: str, service_type: ServiceType) -> Optional[ModelInfo]:
         """تحليل موديل OpenAI"""
-        try:
-            model_lower = model_name.lower()
-            version = "1.0"
-            priority = 100
-            
-            if service_type == ServiceType.CHAT:
-                if 'gpt-4o' in model_lower:
-                    version = "4.0"
-                    priority = 5 if 'mini' in model_lower else 10
-                elif 'gpt-4-turbo' in model_lower:
-                    version = "4.0"
-                    priority = 15
-                elif 'gpt-4' in model_lower:
-                    version = "4.0"
-                    priority = 20
-                elif 'gpt-3.5-turbo' in model_lower:
-                    version = "3.5"
-                    priority = 30 if 'instruct' in model_lower else 25
-                else:
-                    return None
-                    
-            elif service_type == ServiceType.IMAGE:
-                if 'dall-e-3' in model_lower:
-                    version = "3.0"
-                    priority = 5
-                elif 'dall-e-2' in model_lower:
-                    version = "2.0"
-                    priority = 10
-                else:
-                    return None
-            
-            return ModelInfo(
-                name=model_name,
-                provider=Provider.OPENAI,
-                service_type=service_type,
-                version=version,
-                priority=priority,
-                supports_enhancement=True
-            )
-            
-        except Exception as e:
-            logger.debug(f"⚠️ فشل تحليل موديل OpenAI {model_name}: {e}")
+        model_lower = model_name.lower()
+        
+        match = _OPENAI_CLASSIFIER.search(model_lower)
+        if not match:
             return None
-    
+        
+        detected_type, version, priority = _OPENAI_CLASSES[match.lastgroup]
+        if detected_type != service_type:
+            return None
+        
+        if match.lastgroup == 'gpt4o' and 'mini' in model_lower:
+            priority = 5
+        elif match.lastgroup == 'gpt35' and 'instruct' in model_lower:
+            priority = 30
+        
+        return ModelInfo(
+            name=model_name,
+            provider=Provider.OPENAI,
+            service_type=service_type,
+            version=version,
+            priority=priority,
+            supports_enhancement=True
+        )
+        
     async def _setup_other_apis(self):
         """إعداد باقي APIs (تم تصحيح تسجيل موديل Stability)"""
         # Stability AI
@@ -408,7 +748,8 @@ class SmartAIManager:
                 self.stability_headers = {
                     "Authorization": f"Bearer {stability_config.api_key}",
                     "Content-Type": "application/json",
-                    "Accept": "application/json",
+                    # طلب الصورة مباشرة بدلاً من JSON يحوي base64 (أصغر بـ 33% وبدون فك تشفير)
+                    "Accept": "image/png",
                     "User-Agent": "SmartAIManager/5.1"
                 }
                 self.stability_url = os.getenv(
@@ -424,8 +765,9 @@ class SmartAIManager:
                     version="XL 1.0",
                     priority=5  # أولوية قصوى (قبل جوجل)
                 )
-                stability_config.discovered_models[ServiceType.IMAGE] = [model_info]
+                stability_config.set_discovered_models(ServiceType.IMAGE, [model_info])
                 stability_config.active_models[ServiceType.IMAGE] = "stable-diffusion-xl"
+                stability_config.active_model_index[ServiceType.IMAGE] = 0
                 
                 logger.info("✅ تم تفعيل Stability AI (Stable Diffusion XL)")
         
@@ -441,8 +783,9 @@ class SmartAIManager:
                 }
                 # إضافة موديل Luma (لتجنب نفس المشكلة في الفيديو)
                 luma_model = ModelInfo(name="dream-machine", provider=Provider.LUMA, service_type=ServiceType.VIDEO, priority=10)
-                luma_config.discovered_models[ServiceType.VIDEO] = [luma_model]
+                luma_config.set_discovered_models(ServiceType.VIDEO, [luma_model])
                 luma_config.active_models[ServiceType.VIDEO] = "dream-machine"
+                luma_config.active_model_index[ServiceType.VIDEO] = 0
 
         # Kling AI
         kling_config = self.providers[Provider.KLING]
@@ -457,6 +800,10 @@ class SmartAIManager:
     
     def _log_discovery_results(self):
         """تسجيل نتائج الاكتشاف (عرض القائمة كاملة)"""
+        # لا داعي لبناء القائمة إذا كان مستوى التسجيل أعلى من INFO
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        
         logger.info("=" * 50)
         logger.info("📊 نتائج اكتشاف الموديلات (القائمة الكاملة):")
         
@@ -464,17 +811,17 @@ class SmartAIManager:
             if not config.enabled:
                 continue
             
-            logger.info(f"\n🔹 {provider_name.value.upper()}:")
+            logger.info("\n🔹 %s:", provider_name.value.upper())
             
             for service_type, models in config.discovered_models.items():
                 if models:
-                    logger.info(f"  {service_type.value} ({len(models)} models):")
+                    logger.info("  %s (%d models):", service_type.value, len(models))
                     for i, model in enumerate(models):
                         # ✅ تعديل: وضع نجمة لأول 16 موديل (لأننا سنحاول 16 مرة)
                         status = "⭐" if i < 16 else "  "
-                        logger.info(f"    {status} [{i+1}] {model.name} (Priority: {model.priority})")
+                        logger.info("    %s [%d] %s (Priority: %d)", status, i + 1, model.name, model.priority)
                 else:
-                    logger.info(f"  {service_type.value}: ❌ لا توجد موديلات")
+                    logger.info("  %s: ❌ لا توجد موديلات", service_type.value)
         
         logger.info("=" * 50)
     
@@ -484,10 +831,11 @@ class SmartAIManager:
             if not config.enabled:
                 continue
             
+            # القوائم مرتبة مسبقاً حسب الأولوية، لذا الأفضل هو الأول
             for service_type, models in config.discovered_models.items():
                 if models:
-                    best_model = min(models, key=lambda x: x.priority)
-                    config.active_models[service_type] = best_model.name
+                    config.active_models[service_type] = models[0].name
+                    config.active_model_index[service_type] = 0
     
     def _extract_version_number(self, version_str: str) -> float:
         """استخراج رقم الإصدار"""
@@ -500,24 +848,11 @@ class SmartAIManager:
     
     def get_available_providers(self, service_type: ServiceType) -> List[ProviderConfig]:
         """الحصول على المزودين المتاحين"""
-        available = []
-        
-        for provider in self.providers.values():
-            if not provider.enabled or provider.usage_today >= provider.daily_limit:
-                continue
-            
-            if service_type == ServiceType.CHAT:
-                if provider.name in [Provider.GOOGLE, Provider.OPENAI]:
-                    available.append(provider)
-            elif service_type == ServiceType.IMAGE:
-                if provider.name in [Provider.GOOGLE, Provider.OPENAI, Provider.STABILITY]:
-                    available.append(provider)
-            elif service_type == ServiceType.VIDEO:
-                if provider.name in [Provider.GOOGLE, Provider.LUMA, Provider.KLING]:
-                    available.append(provider)
-        
-        available.sort(key=lambda x: (x.errors_today, x.usage_today))
-        return available
+        return sorted(
+            (p for p in self._providers_by_service.get(service_type, ())
+             if p.enabled and p.usage_today < p.daily_limit),
+            key=lambda x: (x.errors_today, x.usage_today)
+        )
     
     def get_active_model(self, provider: Provider, service_type: ServiceType) -> Optional[str]:
         """الحصول على الموديل النشط"""
@@ -537,81 +872,99 @@ class SmartAIManager:
         if not models:
             return None
         
-        if not current_model or current_model not in [m.name for m in models]:
-            new_model = models[0].name
-        else:
-            current_index = None
-            for i, model in enumerate(models):
-                if model.name == current_model:
-                    current_index = i
-                    break
-            
-            if current_index is None or current_index >= len(models) - 1:
-                new_model = models[0].name
-            else:
-                new_model = models[current_index + 1].name
+        # موقع الموديل الحالي من الفهرس الجانبي (O(1) بدلاً من البحث في القائمة)
+        index = config.model_index.get(service_type, {}).get(current_model, -1) if current_model else -1
+        index = (index + 1) % len(models)
         
+        new_model = models[index].name
+        config.active_model_index[service_type] = index
         config.active_models[service_type] = new_model
-        logger.info(f"🔄 تدوير موديل {provider.value}/{service_type.value}: {current_model or 'None'} → {new_model}")
+        logger.info("🔄 تدوير موديل %s/%s: %s → %s", provider.value, service_type.value, current_model or 'None', new_model)
         return new_model
     
     async def _execute_with_fallback(self, provider: Provider, service_type: ServiceType, 
-                                   execute_func, max_retries: int = 3):
-        """تنفيذ مع نظام fallback"""
+                                   execute_func, *args, max_retries: int = 3):
+        """تنفيذ مع نظام fallback (execute_func تُستدعى بـ (model_name, *args))"""
+        # قراءة قيم الـ Enum مرة واحدة بدلاً من كل محاولة/سطر تسجيل
+        pname = provider.value
+        sname = service_type.value
+        
         config = self.providers.get(provider)
         if not config or not config.enabled:
-            raise Exception(f"المزود {provider.value} غير مفعل")
+            raise Exception(f"المزود {pname} غير مفعل")
         
         current_model = self.get_active_model(provider, service_type)
         original_model = current_model
         
+        # الموديلات التي فشلت في هذا الطلب (لعدم تكرارها بعد الدوران)
+        tried_models = set()
+        
         for attempt in range(max_retries):
             try:
                 if not current_model:
-                    models = config.discovered_models.get(service_type, [])
+                    models = config.discovered_models.get(service_type, ())
                     if not models:
-                        raise Exception(f"لا توجد موديلات لـ {service_type.value}")
+                        raise Exception(f"لا توجد موديلات لـ {sname}")
                     current_model = models[0].name
                     config.active_models[service_type] = current_model
+                    config.active_model_index[service_type] = 0
+                
+                logger.info("🔄 محاولة %d/%d مع %s/%s", attempt + 1, max_retries, pname, current_model)
                 
-                logger.info(f"🔄 محاولة {attempt+1}/{max_retries} مع {provider.value}/{current_model}")
+                # انتظار محلي بدلاً من رفض 429 من المزود
+                await self._buckets[provider].acquire()
                 
-                result = await execute_func(current_model)
-                return result
+                semaphore = self._provider_sem[provider]
+                if semaphore.locked():
+                    logger.warning("🚦 %s: تم بلوغ حد الطلبات المتزامنة، الطلب في الانتظار", pname)
+                async with semaphore:
+                    return await execute_func(current_model, *args)
                 
             except Exception as e:
                 error_msg = str(e)
-                logger.error(f"❌ خطأ في {provider.value}/{current_model}: {error_msg}")
+                logger.error("❌ خطأ في %s/%s: %s", pname, current_model, error_msg)
                 
-                is_quota_error = any(keyword in error_msg.lower() for keyword in [
-                    '429', 'quota', 'rate limit', 'resource exhausted'
-                ])
-                is_model_error = any(keyword in error_msg.lower() for keyword in [
-                    '404', 'not found', 'invalid model', 'model not found'
-                ])
+                is_quota_error = _QUOTA_ERROR_RE.search(error_msg) is not None
+                is_model_error = _MODEL_ERROR_RE.search(error_msg) is not None
+                retry_after = getattr(e, "retry_after", None)
                 
                 if is_quota_error or is_model_error:
-                    logger.warning(f"⚠️ {provider.value}: خطأ في الموديل {current_model}")
+                    logger.warning("⚠️ %s: خطأ في الموديل %s", pname, current_model)
+                    
+                    tried_models.add(current_model)
+                    if len(tried_models) >= len(config.discovered_models.get(service_type, ())):
+                        logger.error("❌ تم تجربة جميع موديلات %s/%s", pname, sname)
+                        raise Exception(f"فشلت جميع موديلات {pname} ({len(tried_models)} موديل)")
                     
                     next_model = self.rotate_model(provider, service_type, current_model)
                     
                     if next_model and next_model != current_model:
                         current_model = next_model
-                        logger.info(f"🔄 الانتقال للموديل التالي: {next_model}")
+                        logger.info("🔄 الانتقال للموديل التالي: %s", next_model)
+                        # خطأ حصة: ننتظر قبل الطلب التالي بدل استنزاف الحصة بمحاولات فورية
+                        if is_quota_error:
+                            await asyncio.sleep(_backoff_delay(attempt, retry_after))
                         continue
                     else:
-                        logger.error(f"❌ لا توجد موديلات بديلة لـ {provider.value}")
+                        logger.error("❌ لا توجد موديلات بديلة لـ %s", pname)
                         break
+                elif retry_after is not None:
+                    # 503 مؤقت (مثلاً الموديل قيد التحميل): نعيد نفس الموديل بعد المهلة المطلوبة
+                    delay = _backoff_delay(attempt, retry_after)
+                    logger.warning("⏳ %s مشغول، إعادة المحاولة بعد %.1f ثانية", pname, delay)
+                    await asyncio.sleep(delay)
+                    continue
                 else:
-                    logger.error(f"❌ {provider.value}: خطأ غير متعلق بالموديل")
+                    logger.error("❌ %s: خطأ غير متعلق بالموديل", pname)
                     break
         
-        raise Exception(f"فشلت جميع محاولات {provider.value} ({max_retries} محاولات)")
+        raise Exception(f"فشلت جميع محاولات {pname} ({max_retries} محاولات)")
     
     # ==================== خدمة المحادثة (كاملة) ====================
     
     async def chat_with_ai(self, user_id: int, message: str) -> str:
         """خدمة المحادثة مع fallback ذكي"""
+        reserved = False
         try:
             # التأكد من أن الاكتشاف تم
             await self.ensure_discovery()
@@ -626,7 +979,8 @@ class SmartAIManager:
             if len(message) > 4000:
                 message = message[:4000] + "..."
             
-            allowed, remaining = self.check_user_limit(user_id, "ai_chat")
+            allowed, remaining = await self.check_user_limit(user_id, "ai_chat")
+            reserved = allowed
             if not allowed:
                 return f"❌ عذراً، لقد استهلكت رصيدك اليومي من الرسائل. ({remaining} متبقي)"
             
@@ -637,35 +991,19 @@ class SmartAIManager:
             
             errors = []
             
-            for provider_config in providers:
-                try:
-                    provider = provider_config.name
-                    
-                    async def execute_chat(model_name: str):
-                        if provider == Provider.GOOGLE:
-                            return await self._chat_with_google(model_name, user_id, message)
-                        elif provider == Provider.OPENAI:
-                            return await self._chat_with_openai(model_name, message)
-                        else:
-                            raise Exception(f"مزود غير مدعوم: {provider}")
-                    
-                    # ✅ زيادة المحاولات إلى 16 (كما طلبت)
-                    response = await self._execute_with_fallback(
-                        provider, ServiceType.CHAT, execute_chat, max_retries=16
-                    )
-                    
-                    if response:
-                        self.update_user_usage(user_id, "ai_chat")
-                        provider_config.usage_today += 1
-                        self.db.save_ai_conversation(user_id, "chat", message, response)
-                        return response
-                        
-                except Exception as e:
-                    error_msg = str(e)
-                    errors.append(f"{provider_config.name.value}: {error_msg[:100]}")
-                    provider_config.errors_today += 1
-                    provider_config.last_error = error_msg
-                    continue
+            # سباق بين المزودين: المزود التالي يبدأ إذا تأخر السابق أو فشل
+            response, provider_config = await self._run_hedged(
+                providers,
+                lambda provider_config: self._chat_via_provider(provider_config, user_id, message),
+                self.chat_hedge_delay,
+                errors
+            )
+            
+            if response:
+                self.update_user_usage(user_id, "ai_chat")
+                provider_config.usage_today += 1
+                self.db.save_ai_conversation(user_id, "chat", message, response)
+                return response
             
             if errors:
                 error_summary = "\n".join(errors[:3])
@@ -675,6 +1013,82 @@ class SmartAIManager:
         except Exception as e:
             logger.error(f"❌ خطأ عام في المحادثة: {e}", exc_info=True)
             return "⚠️ حدث خطأ غير متوقع في النظام."
+        finally:
+            if reserved:
+                self._release_user_limit(user_id, "ai_chat")
+    
+    async def _chat_via_provider(self, provider_config: ProviderConfig, user_id: int, message: str) -> str:
+        """المحادثة عبر مزود واحد (مع تدوير موديلاته)"""
+        provider = provider_config.name
+        
+        async def execute_chat(model_name: str):
+            if provider == Provider.GOOGLE:
+                return await self._chat_with_google(model_name, user_id, message)
+            elif provider == Provider.OPENAI:
+                return await self._chat_with_openai(model_name, message)
+            else:
+                raise Exception(f"مزود غير مدعوم: {provider}")
+        
+        # ✅ زيادة المحاولات إلى 16 (كما طلبت)
+        return await self._execute_with_fallback(
+            provider, ServiceType.CHAT, execute_chat, max_retries=16
+        )
+    
+    async def _run_hedged(self, providers: List[ProviderConfig], run_provider, hedge_delay: float,
+                          errors: List[str]) -> Tuple[Any, Optional[ProviderConfig]]:
+        """
+        طلبات متحوطة (Hedged): نبدأ بأفضل مزود، وإذا لم يرد خلال hedge_delay
+        أو فشل نطلق المزود التالي، ونأخذ أول نتيجة ناجحة ونلغي الباقي
+        """
+        task_providers: Dict[asyncio.Task, ProviderConfig] = {}
+        pending = set()
+        next_index = 0
+        
+        def launch_next():
+            nonlocal next_index
+            provider_config = providers[next_index]
+            next_index += 1
+            task = asyncio.create_task(run_provider(provider_config))
+            task_providers[task] = provider_config
+            pending.add(task)
+        
+        launch_next()
+        
+        try:
+            while pending:
+                timeout = hedge_delay if next_index < len(providers) else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                
+                if not done:
+                    # المزود الحالي بطيء (وليس فاشلاً) - نطلق التالي بالتوازي
+                    logger.info("⏱️ تأخر %s، إطلاق المزود التالي بالتوازي", task_providers[next(iter(pending))].name.value)
+                    launch_next()
+                    continue
+                
+                for task in done:
+                    pending.discard(task)
+                    provider_config = task_providers[task]
+                    error = task.exception()
+                    
+                    if error is None:
+                        result = task.result()
+                        if result:
+                            return result, provider_config
+                        continue
+                    
+                    error_msg = str(error)
+                    errors.append(f"{provider_config.name.value}: {error_msg[:100]}")
+                    provider_config.errors_today += 1
+                    provider_config.last_error = error_msg
+                
+                # فشل مزود - ننتقل للتالي فوراً
+                if next_index < len(providers):
+                    launch_next()
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        return None, None
     
     async def _chat_with_google(self, model_name: str, user_id: int, message: str) -> str:
         """الدردشة مع Google Gemini"""
@@ -691,11 +1105,17 @@ class SmartAIManager:
                 ])
                 self.chat_sessions[user_id] = {
                     "chat": chat,
-                    "last_activity": datetime.now()
+                    "last_activity": time.monotonic()
                 }
+                
+                # حد أقصى لعدد الجلسات: طرد الأقدم نشاطاً (LRU)
+                while len(self.chat_sessions) > self.max_chat_sessions:
+                    evicted_user, _ = self.chat_sessions.popitem(last=False)
+                    logger.debug("🧹 طرد جلسة المستخدم %s (تجاوز الحد الأقصى للجلسات)", evicted_user)
             
             session = self.chat_sessions[user_id]
-            session["last_activity"] = datetime.now()
+            session["last_activity"] = time.monotonic()
+            self.chat_sessions.move_to_end(user_id)
             chat_session = session["chat"]
             
             response = await asyncio.wait_for(
@@ -717,14 +1137,12 @@ class SmartAIManager:
         """الدردشة مع OpenAI"""
         try:
             response = await asyncio.wait_for(
-                asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: self.openai_client.chat.completions.create(
-                        model=model_name,
-                        messages=[{"role": "user", "content": message}],
-                        max_tokens=1000,
-                        temperature=0.7
-                    )
+                asyncio.to_thread(
+                    self.openai_client.chat.completions.create,
+                    model=model_name,
+                    messages=[{"role": "user", "content": message}],
+                    max_tokens=1000,
+                    temperature=0.7
                 ),
                 timeout=30.0
             )
@@ -736,23 +1154,25 @@ class SmartAIManager:
     
     def _cleanup_old_sessions(self):
         """تنظيف الجلسات القديمة"""
-        now = datetime.now()
-        to_delete = []
+        now = time.monotonic()
+        deleted = 0
         
-        for user_id, session_data in self.chat_sessions.items():
-            if now - session_data["last_activity"] > self.session_timeout:
-                to_delete.append(user_id)
+        # الجلسات مرتبة حسب آخر نشاط، لذا نتوقف عند أول جلسة غير منتهية
+        while self.chat_sessions:
+            session_data = next(iter(self.chat_sessions.values()))
+            if now - session_data["last_activity"] <= self.session_timeout:
+                break
+            self.chat_sessions.popitem(last=False)
+            deleted += 1
         
-        for user_id in to_delete:
-            del self.chat_sessions[user_id]
-        
-        if to_delete:
-            logger.info(f"🧹 تم تنظيف {len(to_delete)} جلسة قديمة")
+        if deleted:
+            logger.info(f"🧹 تم تنظيف {deleted} جلسة قديمة")
     
     # ==================== خدمة الصور (كاملة) ====================
     
     async def generate_image(self, user_id: int, prompt: str, style: str = "realistic") -> Tuple[Optional[str], str]:
         """توليد صور مع fallback ذكي"""
+        reserved = False
         try:
             # التأكد من أن الاكتشاف تم
             await self.ensure_discovery()
@@ -767,7 +1187,8 @@ class SmartAIManager:
             if len(prompt) > 2000:
                 prompt = prompt[:2000]
             
-            allowed, remaining = self.check_user_limit(user_id, "image_gen")
+            allowed, remaining = await self.check_user_limit(user_id, "image_gen")
+            reserved = allowed
             if not allowed:
                 return None, f"❌ انتهى رصيد الصور اليومي. ({remaining} متبقي)"
             
@@ -776,52 +1197,28 @@ class SmartAIManager:
             if not providers:
                 return None, "⚠️ جميع خدمات توليد الصور غير متاحة."
             
-            errors = []
-            
-            # تحسين الوصف
-            enhanced_prompt = await self._enhance_image_prompt(prompt, style)
+            # طلبات متزامنة بنفس الوصف والنمط تشترك في توليد واحد
+            key = hashlib.blake2b(f"image\0{style}\0{prompt}".encode(), digest_size=16).digest()
+            image_url, provider_config, errors = await self._single_flight(
+                self._generation_inflight, key,
+                lambda: self._generate_image_shared(prompt, style, providers)
+            )
             
-            for provider_config in providers:
-                try:
-                    provider = provider_config.name
-                    
-                    async def execute_image(model_name: str):
-                        if provider == Provider.GOOGLE:
-                            return await self._generate_image_google(model_name, enhanced_prompt)
-                        elif provider == Provider.OPENAI:
-                            return await self._generate_image_openai(model_name, enhanced_prompt)
-                        elif provider == Provider.STABILITY:
-                            return await self._generate_image_stability(enhanced_prompt, style)
-                        else:
-                            raise Exception(f"مزود غير مدعوم للصور: {provider}")
-                    
-                    # ✅ زيادة المحاولات إلى 6
-                    image_url = await self._execute_with_fallback(
-                        provider, ServiceType.IMAGE, execute_image, max_retries=6
-                    )
-                    
-                    if image_url:
-                        self.update_user_usage(user_id, "image_gen")
-                        provider_config.usage_today += 1
-                        self.db.save_generated_file(user_id, "image", prompt, image_url)
-                        
-                        # حفظ في الكاش
-                        cache_key = f"image_{user_id}_{hashlib.md5(prompt.encode()).hexdigest()[:12]}"
-                        self.generated_files_cache[cache_key] = {
-                            "url": image_url,
-                            "prompt": prompt,
-                            "provider": provider.value,
-                            "timestamp": datetime.now().isoformat()
-                        }
-                        
-                        return image_url, "✅ تم إنشاء الصورة بنجاح"
-                        
-                except Exception as e:
-                    error_msg = str(e)
-                    errors.append(f"{provider_config.name.value}: {error_msg[:100]}")
-                    provider_config.errors_today += 1
-                    provider_config.last_error = error_msg
-                    continue
+            if image_url:
+                # كل مستخدم يُحسب عليه الطلب حتى لو شارك نتيجة طلب آخر
+                self.update_user_usage(user_id, "image_gen")
+                self.db.save_generated_file(user_id, "image", prompt, image_url)
+                
+                # حفظ في الكاش
+                cache_key = f"image_{user_id}_{_prompt_key(prompt)}"
+                self.generated_files_cache[cache_key] = {
+                    "url": image_url,
+                    "prompt": prompt,
+                    "provider": provider_config.name.value,
+                    "timestamp": datetime.now().isoformat()
+                }
+                
+                return image_url, "✅ تم إنشاء الصورة بنجاح"
             
             if errors:
                 error_summary = "\n".join(errors[:3])
@@ -831,6 +1228,39 @@ class SmartAIManager:
         except Exception as e:
             logger.error(f"❌ خطأ عام في توليد الصور: {e}", exc_info=True)
             return None, "⚠️ حدث خطأ غير متوقع في خدمة الصور."
+        finally:
+            if reserved:
+                self._release_user_limit(user_id, "image_gen")
+    
+    async def _generate_image_shared(self, prompt: str, style: str,
+                                     providers: List[ProviderConfig]) -> Tuple[Optional[str], Optional[ProviderConfig], List[str]]:
+        """تحسين الوصف ثم السباق بين مزودي الصور (مرة واحدة لكل وصف متزامن)"""
+        errors = []
+        
+        # تحسين الوصف
+        enhanced_prompt = await self._enhance_image_prompt(prompt, style)
+        
+        image_url, provider_config = await self._run_hedged(
+            providers,
+            lambda provider_config: self._image_via_provider(provider_config, enhanced_prompt, style),
+            self.image_hedge_delay,
+            errors
+        )
+        if image_url:
+            provider_config.usage_today += 1
+        return image_url, provider_config, errors
+    
+    async def _image_via_provider(self, provider_config: ProviderConfig, enhanced_prompt: str, style: str) -> str:
+        """توليد صورة عبر مزود واحد (مع تدوير موديلاته)"""
+        provider = provider_config.name
+        generate = self._image_dispatch.get(provider)
+        if generate is None:
+            raise Exception(f"مزود غير مدعوم للصور: {provider}")
+        
+        # ✅ زيادة المحاولات إلى 6
+        return await self._execute_with_fallback(
+            provider, ServiceType.IMAGE, generate, enhanced_prompt, style, max_retries=6
+        )
     
     async def _enhance_image_prompt(self, prompt: str, style: str) -> str:
         """تحسين وصف الصورة"""
@@ -858,6 +1288,44 @@ class SmartAIManager:
         الإخراج: وصف إنجليزي فقط
         """
         
+        return await self._cached_enhancement(
+            f"image\0{style}\0{prompt}",
+            enhancement_prompt,
+            50,  # التأكد من وجود محتوى كافي
+            f"{prompt}, {style} style, professional photography, detailed, 4k"
+        )
+    
+    async def _cached_enhancement(self, key_text: str, enhancement_prompt: str, min_length: int,
+                                  fallback: str) -> str:
+        """
+        تحسين وصف مع كاش TTL ودمج الطلبات المتزامنة المتطابقة (single-flight)
+        """
+        key = hashlib.blake2b(key_text.encode(), digest_size=16).digest()
+        
+        entry = self._enhanced_prompts.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        
+        return await self._single_flight(
+            self._enhance_inflight, key,
+            lambda: self._enhance_and_cache(key, enhancement_prompt, min_length, fallback)
+        )
+    
+    async def _single_flight(self, inflight: Dict[bytes, asyncio.Task], key: bytes, factory):
+        """تشغيل طلب واحد لكل مفتاح: الطلبات المتزامنة المتطابقة تنتظر نفس المهمة"""
+        task = inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            inflight[key] = task
+            task.add_done_callback(lambda _: inflight.pop(key, None))
+        
+        # shield: إلغاء أحد المنتظرين لا يلغي الطلب المشترك
+        return await asyncio.shield(task)
+    
+    async def _enhance_and_cache(self, key: bytes, enhancement_prompt: str, min_length: int,
+                                 fallback: str) -> str:
+        """طلب التحسين من Gemini وتخزين النتيجة (أو الوصف الاحتياطي لمدة أقصر)"""
+        enhanced = None
         try:
             # استخدام Google Gemini لتحسين الوصف
             google_config = self.providers[Provider.GOOGLE]
@@ -869,22 +1337,25 @@ class SmartAIManager:
                     timeout=15.0
                 )
                 if response and response.text:
-                    enhanced = response.text.strip()
-                    if len(enhanced) > 50:  # التأكد من وجود محتوى كافي
-                        return enhanced
+                    text = response.text.strip()
+                    if len(text) > min_length:
+                        enhanced = text
         except Exception as e:
             logger.debug(f"⚠️ فشل تحسين الوصف: {e}")
         
-        return f"{prompt}, {style} style, professional photography, detailed, 4k"
+        if enhanced is None:
+            self._enhanced_prompts[key] = (time.monotonic() + self.enhance_fallback_ttl, fallback)
+            return fallback
+        
+        self._enhanced_prompts[key] = (time.monotonic() + self.enhance_cache_ttl, enhanced)
+        return enhanced
     
-    async def _generate_image_google(self, model_name: str, prompt: str) -> str:
+    async def _generate_image_google(self, model_name: str, prompt: str, style: str = None) -> str:
         """توليد صورة (يدعم التبديل التلقائي عند الفشل)"""
         try:
             logger.info(f"🎨 محاولة توليد صورة باستخدام: {model_name}...")
             
-            if not os.path.exists("downloads"):
-                os.makedirs("downloads")
-            filename = f"downloads/img_{int(time.time())}.png"
+            filename = f"downloads/img_{uuid.uuid4().hex}.png"
 
             api_key = self.providers[Provider.GOOGLE].api_key
             # استخدام الموديل المتغير (الذي يحدده نظام الـ Fallback)
@@ -895,51 +1366,49 @@ class SmartAIManager:
                 "parameters": {"sampleCount": 1, "aspectRatio": "1:1"}
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, headers={'Content-Type': 'application/json'}) as response:
-                    # إذا فشل الموديل (مثلاً 404 للموزة)، نرفع خطأ ليتم التقاطه
-                    if response.status != 200:
-                        error_text = await response.text()
-                        # نرفع Exception يحتوي على 404 ليفهم النظام ويجرب الموديل التالي
-                        raise Exception(f"Google Error {response.status}: {error_text}")
+            session = await self._get_http()
+            # مهلة Imagen أطول من مهلة الجلسة الافتراضية (30 ثانية)
+            timeout = aiohttp.ClientTimeout(total=300)
+            async with session.post(url, json=payload, headers={'Content-Type': 'application/json'}, timeout=timeout) as response:
+                # إذا فشل الموديل (مثلاً 404 للموزة)، نرفع خطأ ليتم التقاطه
+                if response.status != 200:
+                    error_text = await response.text()
+                    # نرفع Exception يحتوي على 404 ليفهم النظام ويجرب الموديل التالي
+                    raise ProviderError(f"Google Error {response.status}: {error_text}", _parse_retry_after(response))
                     
-                    result = await response.json()
+                result = await response.json(loads=fast_json.loads)
                     
-                    predictions = result.get('predictions', [])
-                    if not predictions:
-                        raise Exception("لم يتم استلام تنبؤات (Empty Response)")
+                predictions = result.get('predictions', [])
+                if not predictions:
+                    raise Exception("لم يتم استلام تنبؤات (Empty Response)")
                     
-                    b64_data = predictions[0].get('bytesBase64Encoded')
-                    if not b64_data:
-                         b64_data = predictions[0].get('image', {}).get('bytesBase64Encoded')
+                b64_data = predictions[0].get('bytesBase64Encoded')
+                if not b64_data:
+                     b64_data = predictions[0].get('image', {}).get('bytesBase64Encoded')
                          
-                    if not b64_data:
-                        raise Exception("تنسيق الصورة غير معروف")
+                if not b64_data:
+                    raise Exception("تنسيق الصورة غير معروف")
                         
-                    image_data = base64.b64decode(b64_data)
-                    with open(filename, "wb") as f:
-                        f.write(image_data)
+                await asyncio.to_thread(_decode_and_write, b64_data, filename)
                         
-                    return filename
+                return filename
 
         except Exception as e:
             # هنا لا نقوم بالتحويل لـ OpenAI فوراً
             # بل نترك الخطأ يصعد لكي يقوم _execute_with_fallback بتجربة موديل جوجل التالي
             raise e
     
-    async def _generate_image_openai(self, model_name: str, prompt: str) -> str:
+    async def _generate_image_openai(self, model_name: str, prompt: str, style: str = None) -> str:
         """توليد صورة باستخدام OpenAI DALL-E"""
         try:
             response = await asyncio.wait_for(
-                asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: self.openai_client.images.generate(
-                        model=model_name,
-                        prompt=prompt[:1000],
-                        size="1024x1024",
-                        quality="standard",
-                        n=1
-                    )
+                asyncio.to_thread(
+                    self.openai_client.images.generate,
+                    model=model_name,
+                    prompt=prompt[:1000],
+                    size="1024x1024",
+                    quality="standard",
+                    n=1
                 ),
                 timeout=60.0
             )
@@ -949,17 +1418,9 @@ class SmartAIManager:
         except Exception as e:
             raise Exception(f"DALL-E error: {str(e)}")
     
-    async def _generate_image_stability(self, prompt: str, style: str) -> str:
+    async def _generate_image_stability(self, model_name: str, prompt: str, style: str) -> str:
         """توليد صورة باستخدام Stability AI (مع حفظ الملف محلياً)"""
         try:
-            style_presets = {
-                "realistic": "photographic",
-                "anime": "anime",
-                "fantasy": "fantasy-art",
-                "cyberpunk": "neon-punk",
-                "watercolor": None
-            }
-            
             # إعداد البيانات
             data = {
                 "text_prompts": [{"text": prompt, "weight": 1}],
@@ -970,43 +1431,48 @@ class SmartAIManager:
                 "steps": 30,
             }
             
-            style_preset = style_presets.get(style)
+            style_preset = _STABILITY_STYLE_PRESETS.get(style)
             if style_preset:
                 data["style_preset"] = style_preset
             
-            async with aiohttp.ClientSession(timeout=self.default_timeout) as session:
-                async with session.post(
-                    self.stability_url,
-                    headers=self.stability_headers,
-                    json=data
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
+            session = await self._get_http()
+            async with session.post(
+                self.stability_url,
+                headers=self.stability_headers,
+                json=data
+            ) as response:
+                if response.status == 200:
+                    # اسم ملف فريد
+                    filename = f"downloads/stability_{uuid.uuid4().hex}.png"
+                    
+                    if response.content_type == "image/png":
+                        # الصورة محدودة الحجم (1024x1024): قراءتها كاملة ثم كتابتها في thread
+                        # بقفزة واحدة؛ انقطاع التدفق لا يترك ملفاً مقطوعاً
+                        image_data = await response.read()
+                        await asyncio.to_thread(_write_file, image_data, filename)
                         
-                        # ✅ التعديل الجديد: فك التشفير وحفظ الملف
-                        if "artifacts" in result and len(result["artifacts"]) > 0:
-                            b64_data = result["artifacts"][0]["base64"]
-                            
-                            # التأكد من وجود مجلد التحميلات
-                            if not os.path.exists("downloads"):
-                                os.makedirs("downloads")
-                            
-                            # اسم ملف فريد
-                            filename = f"downloads/stability_{int(time.time())}.png"
+                        logger.info(f"✅ تم حفظ صورة Stability في: {filename}")
+                        return filename
+                    
+                    # عناوين مخصصة (STABLE_DIFFUSION_URL) قد تتجاهل Accept وترد بـ JSON
+                    result = await response.json(loads=fast_json.loads)
+                        
+                    # فك التشفير وحفظ الملف
+                    artifacts = result.get("artifacts")
+                    if artifacts:
+                        b64_data = artifacts[0]["base64"]
                             
-                            # فك التشفير والحفظ
-                            image_data = base64.b64decode(b64_data)
-                            with open(filename, "wb") as f:
-                                f.write(image_data)
+                        # فك التشفير والحفظ
+                        await asyncio.to_thread(_decode_and_write, b64_data, filename)
                             
-                            logger.info(f"✅ تم حفظ صورة Stability في: {filename}")
-                            return filename  # نرجع مسار الملف بدلاً من base64
-                        else:
-                            raise Exception("لا توجد صور في استجابة Stability")
+                        logger.info(f"✅ تم حفظ صورة Stability في: {filename}")
+                        return filename  # نرجع مسار الملف بدلاً من base64
                     else:
-                        error_text = await response.text()
-                        # تنظيف رسالة الخطأ لتكون مقروءة
-                        raise Exception(f"Stability Error {response.status}")
+                        raise Exception("لا توجد صور في استجابة Stability")
+                else:
+                    # أول 200 حرف تكفي لتصنيف الخطأ (حصة/موديل) دون نسخ الرد كاملاً
+                    error_text = (await response.text())[:200]
+                    raise ProviderError(f"Stability Error {response.status}: {error_text}", _parse_retry_after(response))
                         
         except Exception as e:
             logger.error(f"❌ Stability Error: {str(e)}")
@@ -1016,6 +1482,7 @@ class SmartAIManager:
     
     async def generate_video(self, user_id: int, prompt: str, image_url: str = None) -> Tuple[Optional[str], str]:
         """توليد فيديو مع fallback ذكي"""
+        reserved = False
         try:
             # التأكد من أن الاكتشاف تم
             await self.ensure_discovery()
@@ -1030,7 +1497,8 @@ class SmartAIManager:
             if len(prompt) > 1000:
                 prompt = prompt[:1000]
             
-            allowed, remaining = self.check_user_limit(user_id, "video_gen")
+            allowed, remaining = await self.check_user_limit(user_id, "video_gen")
+            reserved = allowed
             if not allowed:
                 return None, f"❌ انتهى رصيد الفيديوهات اليومي. ({remaining} متبقي)"
             
@@ -1039,52 +1507,28 @@ class SmartAIManager:
             if not providers:
                 return None, "⚠️ جميع خدمات توليد الفيديو غير متاحة."
             
-            errors = []
-            
-            # تحسين الوصف
-            enhanced_prompt = await self._enhance_video_prompt(prompt)
+            # طلبات متزامنة بنفس الوصف والصورة تشترك في توليد واحد
+            key = hashlib.blake2b(f"video\0{image_url or ''}\0{prompt}".encode(), digest_size=16).digest()
+            video_url, provider_config, errors = await self._single_flight(
+                self._generation_inflight, key,
+                lambda: self._generate_video_shared(prompt, image_url, providers)
+            )
             
-            for provider_config in providers:
-                try:
-                    provider = provider_config.name
-                    
-                    async def execute_video(model_name: str):
-                        if provider == Provider.GOOGLE:
-                            return await self._generate_video_google(model_name, enhanced_prompt, image_url)
-                        elif provider == Provider.LUMA:
-                            return await self._generate_video_luma(enhanced_prompt, image_url)
-                        elif provider == Provider.KLING:
-                            return await self._generate_video_kling(enhanced_prompt, image_url)
-                        else:
-                            raise Exception(f"مزود غير مدعوم للفيديو: {provider}")
-                    
-                    # ✅ زيادة المحاولات إلى 6
-                    video_url = await self._execute_with_fallback(
-                        provider, ServiceType.VIDEO, execute_video, max_retries=6
-                    )
-                    
-                    if video_url:
-                        self.update_user_usage(user_id, "video_gen")
-                        provider_config.usage_today += 1
-                        self.db.save_generated_file(user_id, "video", prompt, video_url)
-                        
-                        # حفظ في الكاش
-                        cache_key = f"video_{user_id}_{hashlib.md5(prompt.encode()).hexdigest()[:12]}"
-                        self.generated_files_cache[cache_key] = {
-                            "url": video_url,
-                            "prompt": prompt,
-                            "provider": provider.value,
-                            "timestamp": datetime.now().isoformat()
-                        }
-                        
-                        return video_url, "✅ تم إنشاء الفيديو بنجاح"
-                        
-                except Exception as e:
-                    error_msg = str(e)
-                    errors.append(f"{provider_config.name.value}: {error_msg[:100]}")
-                    provider_config.errors_today += 1
-                    provider_config.last_error = error_msg
-                    continue
+            if video_url:
+                # كل مستخدم يُحسب عليه الطلب حتى لو شارك نتيجة طلب آخر
+                self.update_user_usage(user_id, "video_gen")
+                self.db.save_generated_file(user_id, "video", prompt, video_url)
+                
+                # حفظ في الكاش
+                cache_key = f"video_{user_id}_{_prompt_key(prompt)}"
+                self.generated_files_cache[cache_key] = {
+                    "url": video_url,
+                    "prompt": prompt,
+                    "provider": provider_config.name.value,
+                    "timestamp": datetime.now().isoformat()
+                }
+                
+                return video_url, "✅ تم إنشاء الفيديو بنجاح"
             
             if errors:
                 error_summary = "\n".join(errors[:3])
@@ -1094,6 +1538,40 @@ class SmartAIManager:
         except Exception as e:
             logger.error(f"❌ خطأ عام في توليد الفيديو: {e}", exc_info=True)
             return None, "⚠️ حدث خطأ غير متوقع في خدمة الفيديو."
+        finally:
+            if reserved:
+                self._release_user_limit(user_id, "video_gen")
+    
+    async def _generate_video_shared(self, prompt: str, image_url: Optional[str],
+                                     providers: List[ProviderConfig]) -> Tuple[Optional[str], Optional[ProviderConfig], List[str]]:
+        """تحسين الوصف ثم السباق بين مزودي الفيديو (مرة واحدة لكل وصف متزامن)"""
+        errors = []
+        
+        # تحسين الوصف
+        enhanced_prompt = await self._enhance_video_prompt(prompt)
+        
+        video_url, provider_config = await self._run_hedged(
+            providers,
+            lambda provider_config: self._video_via_provider(provider_config, enhanced_prompt, image_url),
+            self.video_hedge_delay,
+            errors
+        )
+        if video_url:
+            provider_config.usage_today += 1
+        return video_url, provider_config, errors
+    
+    async def _video_via_provider(self, provider_config: ProviderConfig, enhanced_prompt: str,
+                                  image_url: Optional[str]) -> str:
+        """توليد فيديو عبر مزود واحد (مع تدوير موديلاته)"""
+        provider = provider_config.name
+        generate = self._video_dispatch.get(provider)
+        if generate is None:
+            raise Exception(f"مزود غير مدعوم للفيديو: {provider}")
+        
+        # ✅ زيادة المحاولات إلى 6
+        return await self._execute_with_fallback(
+            provider, ServiceType.VIDEO, generate, enhanced_prompt, image_url, max_retries=6
+        )
     
     async def _enhance_video_prompt(self, prompt: str) -> str:
         """تحسين وصف الفيديو"""
@@ -1112,23 +1590,12 @@ class SmartAIManager:
         الإخراج: وصف إنجليزي فقط
         """
         
-        try:
-            google_config = self.providers[Provider.GOOGLE]
-            if google_config.enabled and google_config.active_models.get(ServiceType.CHAT):
-                model_name = google_config.active_models[ServiceType.CHAT]
-                model = genai.GenerativeModel(model_name)
-                response = await asyncio.wait_for(
-                    model.generate_content_async(enhancement_prompt),
-                    timeout=15.0
-                )
-                if response and response.text:
-                    enhanced = response.text.strip()
-                    if len(enhanced) > 100:  # التأكد من وجود محتوى كافي
-                        return enhanced
-        except Exception as e:
-            logger.debug(f"⚠️ فشل تحسين وصف الفيديو: {e}")
-        
-        return f"{prompt}, cinematic, 5 seconds, smooth camera movement, professional lighting"
+        return await self._cached_enhancement(
+            f"video\0{prompt}",
+            enhancement_prompt,
+            100,  # التأكد من وجود محتوى كافي
+            f"{prompt}, cinematic, 5 seconds, smooth camera movement, professional lighting"
+        )
     
     async def _generate_video_google(self, model_name: str, prompt: str, image_url: str = None) -> str:
         """توليد فيديو باستخدام Google Veo"""
@@ -1136,10 +1603,10 @@ class SmartAIManager:
         # مؤقتاً نستخدم fallback لـ Luma إذا كان متاح
         luma_config = self.providers[Provider.LUMA]
         if luma_config.enabled:
-            return await self._generate_video_luma(prompt, image_url)
+            return await self._generate_video_luma(model_name, prompt, image_url)
         raise Exception("Google Veo غير متوفر حالياً")
     
-    async def _generate_video_luma(self, prompt: str, image_url: str = None) -> str:
+    async def _generate_video_luma(self, model_name: str, prompt: str, image_url: str = None) -> str:
         """توليد فيديو باستخدام Luma AI"""
         try:
             url = "https://api.lumalabs.ai/dream-machine/v1/generations"
@@ -1154,54 +1621,57 @@ class SmartAIManager:
             
             timeout = aiohttp.ClientTimeout(total=300)  # 5 دقائق للفيديو
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                # بدء التوليد
-                async with session.post(url, headers=self.luma_headers, json=payload) as response:
-                    if response.status in [200, 201]:
-                        data = await response.json()
-                        generation_id = data.get("id")
-                        
-                        if not generation_id:
-                            raise Exception("لم يتم استلم معرف التوليد")
-                        
-                        # الانتظار والتحقق (بحد أقصى 10 محاولات)
-                        for attempt in range(10):
-                            await asyncio.sleep(10)  # 10 ثواني بين المحاولات
-                            
-                            async with session.get(
-                                f"{url}/{generation_id}",
-                                headers=self.luma_headers
-                            ) as check_response:
-                                if check_response.status == 200:
-                                    status_data = await check_response.json()
-                                    state = status_data.get("state")
-                                    
-                                    if state == "completed":
-                                        video_url = status_data.get("assets", {}).get("video")
-                                        if video_url:
-                                            return video_url
-                                    elif state == "failed":
-                                        failure_reason = status_data.get('failure_reason', 'غير معروف')
-                                        raise Exception(f"فشل التوليد: {failure_reason}")
-                                    elif state == "processing":
-                                        continue  # استمر في الانتظار
-                        
-                        raise Exception("انتهى وقت الانتظار للفيديو (100 ثانية)")
-                    else:
-                        error_text = await response.text()[:200]
-                        raise Exception(f"Luma API error: {response.status} - {error_text}")
+            session = await self._get_http()
+            # بدء التوليد (نقرأ الرد ونعيد الاتصال للـ pool قبل بدء الانتظار)
+            async with session.post(url, headers=self.luma_headers, json=payload, timeout=timeout) as response:
+                if response.status not in [200, 201]:
+                    error_text = (await response.text())[:200]
+                    raise ProviderError(f"Luma API error: {response.status} - {error_text}", _parse_retry_after(response))
+                data = await response.json(loads=fast_json.loads)
+            
+            generation_id = data.get("id")
+            if not generation_id:
+                raise Exception("لم يتم استلم معرف التوليد")
+            
+            # الانتظار والتحقق بتراجع أسي (2 ثانية حتى 15 ثانية) بحد أقصى 180 ثانية
+            delay = 2.0
+            deadline = time.monotonic() + 180
+            while time.monotonic() < deadline:
+                await asyncio.sleep(delay)
+                delay = min(delay * 1.5, 15.0)
+                
+                async with session.get(
+                    f"{url}/{generation_id}",
+                    headers=self.luma_headers,
+                    timeout=timeout
+                ) as check_response:
+                    if check_response.status != 200:
+                        continue
+                    status_data = await check_response.json(loads=fast_json.loads)
+                
+                state = status_data.get("state")
+                
+                if state == "completed":
+                    video_url = status_data.get("assets", {}).get("video")
+                    if video_url:
+                        return video_url
+                elif state == "failed":
+                    failure_reason = status_data.get('failure_reason', 'غير معروف')
+                    raise Exception(f"فشل التوليد: {failure_reason}")
+            
+            raise Exception("انتهى وقت الانتظار للفيديو (180 ثانية)")
         except aiohttp.ClientError as e:
             raise Exception(f"Luma AI connection error: {str(e)}")
         except Exception as e:
-            raise Exception(f"Luma AI error: {str(e)}")
+            raise ProviderError(f"Luma AI error: {str(e)}", getattr(e, "retry_after", None))
     
-    async def _generate_video_kling(self, prompt: str, image_url: str = None) -> str:
+    async def _generate_video_kling(self, model_name: str, prompt: str, image_url: str = None) -> str:
         """توليد فيديو باستخدام Kling AI"""
         # TODO: تنفيذ API call لـ Kling AI
         # مؤقتاً نستخدم fallback لـ Luma
         luma_config = self.providers[Provider.LUMA]
         if luma_config.enabled:
-            return await self._generate_video_luma(prompt, image_url)
+            return await self._generate_video_luma(model_name, prompt, image_url)
         raise Exception("Kling AI غير متوفر حالياً")
     
     # ==================== دوال مساعدة ====================
@@ -1211,82 +1681,141 @@ class SmartAIManager:
         if not text:
             return "عذراً، لم أستطع تكوين رد مناسب."
         
-        try:
-            clean_text = re.sub(r'THOUGHT:.*?(?=\n\n|\Z)', '', text, flags=re.DOTALL | re.IGNORECASE)
-            clean_text = clean_text.replace("THOUGHT:", "").strip()
-            
-            if not clean_text or len(clean_text) < 2:
-                return text
-            return clean_text
-        except:
+        clean_text = _THOUGHT_RE.sub('', text).replace("THOUGHT:", "").strip()
+        
+        if not clean_text or len(clean_text) < 2:
             return text
+        return clean_text
+    
+    def _today(self) -> str:
+        """تاريخ اليوم بتوقيت الخادم (يُحسب مرة واحدة لكل يوم، بدون آثار جانبية)"""
+        if time.time() < self._day_ends_at:
+            return self._today_str
+        
+        today = date.today()
+        self._today_str = today.isoformat()
+        self._day_ends_at = datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+        return self._today_str
     
-    def check_user_limit(self, user_id: int, service_type: str) -> Tuple[bool, int]:
-        """فحص حدود المستخدم"""
+    async def check_user_limit(self, user_id: int, service_type: str) -> Tuple[bool, int]:
+        """
+        فحص حدود المستخدم وحجز وحدة من الرصيد عند السماح
+        (قراءة القاعدة عند غياب الكاش في thread، ثم الفحص والحجز بدون await بينهما فهما ذريّان)
+        يجب تحرير الحجز بـ _release_user_limit بعد انتهاء الطلب
+        """
         try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            cache_key = f"{user_id}_{today}_{service_type}"
-            
-            # تحديث الكاش (LRU)
-            if cache_key in self.user_limits_cache:
-                current_usage = self.user_limits_cache[cache_key]
-                # نقل المفتاح للنهاية (الأحدث)
-                self.user_limits_cache.move_to_end(cache_key)
-            else:
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        'SELECT usage_count FROM ai_usage WHERE user_id = ? AND service_type = ? AND usage_date = ?',
-                        (user_id, service_type, today)
-                    )
-                    result = cursor.fetchone()
-                    current_usage = result[0] if result else 0
-                    self.user_limits_cache[cache_key] = current_usage
-            
-            # التحكم بحجم الكاش
-            if len(self.user_limits_cache) > self.max_cache_size:
-                self.user_limits_cache.popitem(last=False)
-            
-            limits_config = {
-                "ai_chat": int(os.getenv("DAILY_AI_LIMIT", "20")),
-                "image_gen": int(os.getenv("DAILY_IMAGE_LIMIT", "5")),
-                "video_gen": int(os.getenv("DAILY_VIDEO_LIMIT", "2"))
-            }
-            
-            limit = limits_config.get(service_type, 20)
-            
-            if current_usage >= limit:
+            today = self._today()
+            cache_key = (user_id, service_type)
+            usage_cache = self._usage_bucket(today)
+            
+            # قراءة من الكاش (LRU - تُرقّى العقدة تلقائياً عند الإصابة)
+            current_usage = usage_cache.get(cache_key)
+            if current_usage is None:
+                loaded = await asyncio.to_thread(self.db.get_user_usage_count, user_id, service_type, today)
+                # طلب آخر قد يكون ملأ الكاش أثناء القراءة - قيمته أحدث
+                current_usage = usage_cache.get(cache_key)
+                if current_usage is None:
+                    current_usage = loaded
+                    # الكاش يطرد الأقدم تلقائياً عند امتلائه
+                    usage_cache[cache_key] = current_usage
+            
+            limit = self._limits.get(service_type, 20)
+            reservations = self._reserved_usage.setdefault(today, {})
+            reserved = reservations.get(cache_key, 0)
+            
+            # الطلبات الجارية تُحسب ضمن الاستهلاك حتى لا يتجاوز المستخدم حده بطلبات متزامنة
+            if current_usage + reserved >= limit:
                 return False, 0
             
-            return True, limit - current_usage
+            reservations[cache_key] = reserved + 1
+            return True, limit - current_usage - reserved
             
         except Exception as e:
             logger.error(f"❌ خطأ في فحص الحدود: {e}", exc_info=True)
             return True, 999
     
+    def _usage_bucket(self, today: str) -> LRUCache:
+        """كاش استخدام يوم معين (يُنشأ عند أول طلب في اليوم)"""
+        usage_cache = self.user_limits_cache.get(today)
+        if usage_cache is None:
+            usage_cache = self.user_limits_cache[today] = LRUCache(self.max_cache_size)
+        return usage_cache
+    
+    def _release_user_limit(self, user_id: int, service_type: str):
+        """تحرير حجز طلب منتهٍ (نجح أو فشل)"""
+        today = self._today()
+        reservations = self._reserved_usage.get(today)
+        if not reservations:
+            return
+        
+        cache_key = (user_id, service_type)
+        reserved = reservations.get(cache_key, 0)
+        if reserved > 1:
+            reservations[cache_key] = reserved - 1
+        else:
+            reservations.pop(cache_key, None)
+    
     def update_user_usage(self, user_id: int, service_type: str) -> bool:
         """تحديث استخدام المستخدم"""
         try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            cache_key = f"{user_id}_{today}_{service_type}"
-            
-            current = self.user_limits_cache.get(cache_key, 0)
-            self.user_limits_cache[cache_key] = current + 1
-            
-            # تحديث قاعدة البيانات
-            with self.db.get_connection() as conn:
-                conn.execute('''
-                INSERT INTO ai_usage (user_id, service_type, usage_date, usage_count)
-                VALUES (?, ?, ?, 1)
-                ON CONFLICT(user_id, service_type, usage_date) 
-                DO UPDATE SET usage_count = usage_count + 1
-                ''', (user_id, service_type, today))
-                conn.commit()
+            today = self._today()
+            cache_key = (user_id, service_type)
+            usage_cache = self._usage_bucket(today)
+            
+            current = usage_cache.get(cache_key, 0)
+            usage_cache[cache_key] = current + 1
+            
+            # تحديث قاعدة البيانات عبر الكاتب الخلفي (بدون commit داخل حلقة الأحداث)
+            self._usage_queue.put_nowait((user_id, service_type, today))
+            if self._usage_writer_task is None or self._usage_writer_task.done():
+                self._usage_writer_task = asyncio.create_task(self._usage_writer())
             return True
         except Exception as e:
             logger.error(f"❌ خطأ في تحديث الاستخدام: {e}", exc_info=True)
             return False
     
+    async def _usage_writer(self):
+        """تجميع تحديثات الاستخدام (حتى usage_batch_size أو usage_flush_interval) وكتابتها معاً"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._usage_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.usage_flush_interval
+            
+            while len(batch) < self.usage_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._usage_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            try:
+                await asyncio.to_thread(self._flush_usage, batch)
+            except Exception as e:
+                logger.error(f"❌ خطأ في حفظ الاستخدام ({len(batch)} تحديث): {e}", exc_info=True)
+    
+    def _flush_usage(self, batch: List[Tuple[int, str, str]]):
+        """كتابة دفعة تحديثات في معاملة واحدة (التحديثات المكررة تُدمج في صف واحد)"""
+        counts = Counter(batch)
+        with self.db.get_connection() as conn:
+            conn.executemany('''
+            INSERT INTO ai_usage (user_id, service_type, usage_date, usage_count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, service_type, usage_date) 
+            DO UPDATE SET usage_count = usage_count + excluded.usage_count
+            ''', [(user_id, service_type, usage_date, count)
+                  for (user_id, service_type, usage_date), count in counts.items()])
+            conn.commit()
+    
     def get_available_services(self) -> Dict[str, bool]:
         """الحصول على حالة الخدمات"""
         return {
@@ -1297,14 +1826,11 @@ class SmartAIManager:
     
     def get_user_stats(self, user_id: int) -> Dict[str, int]:
         """إحصائيات المستخدم"""
-        stats = {}
-        today = datetime.now().strftime('%Y-%m-%d')
+        usage_cache = self.user_limits_cache.get(self._today())
+        if not usage_cache:
+            return dict.fromkeys(self._limits, 0)
         
-        for service_type in ["ai_chat", "image_gen", "video_gen"]:
-            cache_key = f"{user_id}_{today}_{service_type}"
-            stats[service_type] = self.user_limits_cache.get(cache_key, 0)
-        
-        return stats
+        return {service_type: usage_cache.get((user_id, service_type), 0) for service_type in self._limits}
     
     def get_system_stats(self) -> Dict[str, Any]:
         """إحصائيات النظام"""
@@ -1314,7 +1840,7 @@ class SmartAIManager:
             "total_errors_today": 0,
             "discovery_completed": self.discovery_completed,
             "active_sessions": len(self.chat_sessions),
-            "cache_size": len(self.user_limits_cache),
+            "cache_size": sum(len(usage_cache) for usage_cache in self.user_limits_cache.values()),
             "timestamp": datetime.now().isoformat()
         }
         
@@ -1328,10 +1854,7 @@ class SmartAIManager:
                     "remaining_limit": config.daily_limit - config.usage_today,
                     "last_error": config.last_error[:100] if config.last_error else None,
                     "active_models": config.active_models,
-                    "discovered_models_count": {
-                        st.value: len(models)
-                        for st, models in config.discovered_models.items()
-                    }
+                    "discovered_models_count": config.discovered_models_count
                 }
                 stats["total_requests_today"] += config.usage_today
                 stats["total_errors_today"] += config.errors_today
@@ -1340,16 +1863,15 @@ class SmartAIManager:
     
     def reset_daily_counts(self):
         """إعادة تعيين العدادات"""
-        today = datetime.now().strftime('%Y-%m-%d')
+        today = self._today()
         
-        # إعادة تعيين كاش المستخدمين
-        keys_to_delete = []
-        for key in self.user_limits_cache.keys():
-            if not key.endswith(today):
-                keys_to_delete.append(key)
+        # إعادة تعيين كاش المستخدمين: حذف دلاء الأيام السابقة كاملة
+        for day in [day for day in self.user_limits_cache if day != today]:
+            del self.user_limits_cache[day]
         
-        for key in keys_to_delete:
-            del self.user_limits_cache[key]
+        # حجوزات الأيام السابقة (طلبات عبرت منتصف الليل)
+        for day in [day for day in self._reserved_usage if day != today]:
+            del self._reserved_usage[day]
         
         # إعادة تعيين المزودين
         for provider in self.providers.values():
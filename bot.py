@@ -1,104 +1,64 @@
 # bot.py - النسخة المعدلة للنظام الذكي المتعدد المصادر
 import os
+import sys
+import atexit
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import asyncio
 import time
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.constants import ChatAction
+from telegram.ext import AIORateLimiter, Application, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 from datetime import datetime
 
 # تحميل المتغيرات البيئية
 load_dotenv()
 
+# الحدود اليومية لكل مستخدم (تُقرأ مرة واحدة عند التحميل)
+DAILY_LIMITS = {
+    "ai_chat": int(os.getenv("DAILY_AI_LIMIT", "20")),
+    "image_gen": int(os.getenv("DAILY_IMAGE_LIMIT", "5")),
+    "video_gen": int(os.getenv("DAILY_VIDEO_LIMIT", "2"))
+}
+
 # إعداد التسجيل
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# السجلات توضع في طابور ويكتبها خيط خلفي، فلا تتم الكتابة على خيط حلقة الأحداث
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # ==================== استيراد النظام الذكي الجديد ====================
 from database import db
-from ai_manager import SmartAIManager as AIManager
+from ai_manager import SmartAIManager as AIManager, TTLCache
 
 # ==================== نظام المشرفين ====================
 def get_admin_ids():
     admin_ids_str = os.getenv("ADMIN_IDS", "")
     if admin_ids_str:
         try:
-            return [int(admin_id.strip()) for admin_id in admin_ids_str.split(",")]
+            return [int(admin_id) for admin_id in admin_ids_str.split(",") if admin_id.strip()]
         except ValueError:
             logger.error("❌ خطأ في تنسيق ADMIN_IDS")
             return []
     return []
 
-ADMIN_IDS = get_admin_ids()
+ADMIN_IDS = frozenset(get_admin_ids())
 
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-# إنشاء كائن الذكاء الاصطناعي الذكي
-ai_manager = AIManager(db)
-
-# ==================== دوال مساعدة ====================
-def check_environment():
-    """فحص بيئة التشغيل"""
-    logger.info("=" * 50)
-    logger.info("🔍 فحص بيئة التشغيل...")
-    
-    required_vars = ["BOT_TOKEN", "GOOGLE_AI_API_KEY"]
-    for var in required_vars:
-        value = os.getenv(var)
-        status = "✅ موجود" if value else "❌ مفقود"
-        logger.info(f"{var}: {status}")
-        if value and var == "BOT_TOKEN":
-            logger.info(f"   طول التوكن: {len(value)} حرف")
-    
-    import sys
-    logger.info(f"Python version: {sys.version}")
-    logger.info(f"System: {sys.platform}")
-    logger.info("=" * 50)
-
-# استدعاء الفحص عند البدء
-check_environment()
-
-# ==================== أوامر البوت الأساسية ====================
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    
-    # تسجيل المستخدم في قاعدة البيانات
-    db.add_or_update_user(
-        user_id=user.id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name
-    )
-    
-    # الحصول على حالة النظام
-    system_stats = ai_manager.get_system_stats()
-    provider_count = len([p for p in system_stats.get("providers", {}).values() if p.get("enabled")])
-    
-    # إرسال إشعار ترحيبي
-    await update.message.reply_text(
-        f"🤖 **مرحباً {user.first_name}!**\n\n"
-        f"أنا بوت الذكاء الاصطناعي الذكي المتعدد المصادر! 🚀\n\n"
-        f"🎯 **ما يمكنني فعله:**\n"
-        f"💬 محادثة ذكية مع {provider_count} مزود\n"
-        f"🎨 إنشاء صور احترافية من الوصف\n"
-        f"🎬 إنشاء فيديوهات متحركة متقدمة\n"
-        f"📊 إحصائيات استخدام ذكية\n\n"
-        f"🔍 **معرفك:** {user.id}\n"
-        f"✅ **تم التسجيل بنجاح**\n\n"
-        f"📝 استخدم /help لعرض جميع الأوامر\n"
-        f"🤖 جرب /chat للبدء في المحادثة\n"
-        f"🔧 استخدم /system لرؤية حالة النظام",
-        parse_mode='Markdown'
-    )
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض جميع الأوامر"""
-    help_text = """
+# ==================== النصوص الثابتة ====================
+# نصوص لا تتغير تُبنى مرة واحدة عند التحميل
+HELP_TEXT = """
 🎯 **أوامر البوت الذكي (المتعدد المصادر)**
 
 🤖 **خدمات الذكاء الاصطناعي:**
@@ -135,66 +95,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 🔧 **الدعم:** للاستفسارات تواصل مع @المطور
 """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
 
-async def system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض حالة النظام الذكي والمزودين"""
-    try:
-        # الحصول على إحصائيات النظام
-        system_stats = ai_manager.get_system_stats()
-        services = ai_manager.get_available_services()
-        
-        status_text = "⚙️ **حالة النظام الذكي المتعدد المصادر**\n\n"
-        
-        # حالة الخدمات
-        status_text += "📊 **الخدمات المتاحة:**\n"
-        status_text += f"💬 المحادثة: {'✅ متاحة' if services.get('chat') else '❌ غير متاحة'}\n"
-        status_text += f"🎨 إنشاء الصور: {'✅ متاحة' if services.get('image_generation') else '❌ غير متاحة'}\n"
-        status_text += f"🎬 إنشاء الفيديوهات: {'✅ متاحة' if services.get('video_generation') else '❌ غير متاحة'}\n\n"
-        
-        # المزودين النشطين
-        active_providers = 0
-        providers_text = "🔧 **المزودون النشطون:**\n"
-        
-        for provider_name, provider_info in system_stats.get("providers", {}).items():
-            if provider_info.get("enabled"):
-                active_providers += 1
-                providers_text += f"• {provider_name.upper()}: {provider_info.get('usage_today', 0)} طلب\n"
-        
-        status_text += providers_text + "\n"
-        
-        # إحصائيات اليوم
-        status_text += f"📈 **إحصائيات اليوم:**\n"
-        status_text += f"📤 الطلبات: {system_stats.get('total_requests_today', 0)}\n"
-        status_text += f"❌ الأخطاء: {system_stats.get('total_errors_today', 0)}\n"
-        status_text += f"🔄 المزودون: {active_providers}/{len(system_stats.get('providers', {}))}\n\n"
-        
-        # حالة قاعدة البيانات
-        db_status = check_database_status()
-        status_text += f"💾 **قاعدة البيانات:** {db_status.get('users_count', 0)} مستخدم\n\n"
-        
-        # معلومات النظام
-        status_text += "🕒 **معلومات النظام:**\n"
-        status_text += f"⏰ الوقت: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        status_text += f"👑 المشرفين: {len(ADMIN_IDS)}\n"
-        status_text += f"🚀 المنصة: Railway\n"
-        status_text += f"🔄 الاكتشاف: {'✅ مكتمل' if system_stats.get('discovery_completed') else '⏳ قيد العمل'}\n\n"
-        
-        status_text += "✨ **النظام يعمل بشكل ذكي ومستقر**"
-        
-        await update.message.reply_text(status_text, parse_mode='Markdown')
-        
-    except Exception as e:
-        logger.error(f"❌ خطأ في أمر النظام: {e}")
-        await update.message.reply_text("✅ النظام يعمل، لكن هناك تأخير في جلب التفاصيل.")
-
-async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض حالة البوت (للتوافق)"""
-    await system_command(update, context)
-
-async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض معلومات عن البوت"""
-    about_text = """
+ABOUT_TEXT = """
 🤖 **معلومات البوت الذكي**
 
 الإصدار: 5.0 (النظام الذكي المتعدد المصادر)
@@ -230,11 +132,8 @@ async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 📜 **الشروط:** الاستخدام يعني الموافقة
 """
-    await update.message.reply_text(about_text, parse_mode='Markdown')
 
-async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض حدود الاستخدام اليومية"""
-    limits_text = """
+LIMITS_TEXT = """
 📊 **حدود الاستخدام اليومية (لكل مستخدم)**
 
 🤖 **الذكاء الاصطناعي:**
@@ -253,30 +152,361 @@ async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 3. الفيديوهات تستغرق 2-5 دقائق
 4. يمكنك تتبع استخدامك بـ `/mystats`
 
-🔄 **التجديد:** تلقائي كل 24 ساعة (توقيت UTC)
+🔄 **التجديد:** تلقائي يومياً عند منتصف الليل (توقيت الخادم)
 
 🔍 **لمعرفة المزود المستخدم:** استخدم `/system`
 """
-    await update.message.reply_text(limits_text, parse_mode='Markdown')
+
+CHAT_USAGE_TEXT = (
+    "💬 **المحادثة الذكية**\n\n"
+    "اكتب رسالتك بعد الأمر:\n"
+    "`/chat مرحبا، كيف حالك؟`\n\n"
+    "✨ **المميزات:**\n"
+    "• يستخدم Google Gemini أولاً\n"
+    "• يتبدل لـ OpenAI تلقائياً\n"
+    "• يحفظ سياق المحادثة"
+)
+
+IMAGE_USAGE_TEXT = (
+    "🎨 **إنشاء صور ذكية**\n\n"
+    "**الاستخدام:** `/image <وصف الصورة> [النمط]`\n\n"
+    "**أمثلة:**\n"
+    "`/image قطة لطيفة تجلس على كرسي`\n"
+    "`/image منظر لغروب الشمس realistic`\n"
+    "`/image ساحر في غابة سحرية fantasy`\n\n"
+    "**الأنماط المتاحة:**\n"
+    "`realistic` - واقعي (افتراضي)\n"
+    "`anime` - أنمي / كرتون\n"
+    "`fantasy` - فنتازيا سحرية\n"
+    "`cyberpunk` - مستقبلي تكنولوجي\n"
+    "`watercolor` - ألوان مائية\n\n"
+    "⚡ **النظام الذكي:**\n"
+    "• يستخدم DALL-E 3 أولاً\n"
+    "• يتبدل للبدائل تلقائياً\n"
+    "• يحسن الوصف أوتوماتيكياً\n"
+    "⏳ **المدة:** 10-30 ثانية"
+)
+
+VIDEO_USAGE_TEXT = (
+    "🎬 **إنشاء فيديو ذكي**\n\n"
+    "**طريقتان للاستخدام:**\n\n"
+    "1. **من النص:**\n"
+    "`/video منظر طبيعي لغروب الشمس`\n\n"
+    "2. **من صورة:**\n"
+    "• أرسل صورة أولاً\n"
+    "• ثم رد عليها بالأمر:\n"
+    "`/video إضافة حركة للصورة`\n\n"
+    "**أمثلة:**\n"
+    "`/video مدينة المستقبل بإضاءة نيون`\n"
+    "`/video بحر هائج بأمواج عالية`\n\n"
+    "⚡ **النظام الذكي:**\n"
+    "• يستخدم Luma AI أولاً\n"
+    "• يتبدل للبدائل تلقائياً\n"
+    "• يحسن الوصف سينمائياً\n"
+    "⚠️ **المدة:** 2-5 دقائق"
+)
+
+USAGE_SERVICE_NAMES = {
+    "ai_chat": "💬 المحادثات",
+    "image_gen": "🎨 الصور المولدة",
+    "video_gen": "🎬 الفيديوهات"
+}
+
+# أنماط الصور المدعومة في /image
+VALID_STYLES = frozenset({"realistic", "anime", "fantasy", "cyberpunk", "watercolor"})
+
+# أشرطة التقدم محسوبة مسبقاً (0 إلى 10 مربعات)
+PROGRESS_BARS = tuple("🟩" * i + "⬜" * (10 - i) for i in range(11))
+
+SERVICE_STATUS_NAMES = {
+    "chat": "💬 المحادثة",
+    "image_generation": "🎨 إنشاء صور",
+    "video_generation": "🎬 إنشاء فيديوهات"
+}
+
+# إنشاء كائن الذكاء الاصطناعي الذكي
+ai_manager = AIManager(db)
+
+# ==================== دوال مساعدة ====================
+# كاش قصير لإحصائيات النظام (تتغير على مقياس ثوانٍ، وتُطلب مع كل أمر حالة)
+STATS_CACHE_TTL = 3.0
+_stats_cache = {}  # الاسم -> (وقت الحساب، القيمة)
+
+def _cached_stat(name: str, compute):
+    now = time.monotonic()
+    entry = _stats_cache.get(name)
+    if entry is not None and now - entry[0] < STATS_CACHE_TTL:
+        return entry[1]
+    value = compute()
+    _stats_cache[name] = (now, value)
+    return value
+
+# مهام خلفية لا ننتظرها (نحتفظ بمرجع حتى لا تُجمع قبل انتهائها)
+_background_tasks = set()
+
+def _on_background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.debug(f"⚠️ فشل مهمة خلفية: {task.exception()}")
+
+def _fire_and_forget(coro) -> asyncio.Task:
+    """تشغيل عملية ثانوية (مثل حذف رسالة الانتظار) دون انتظارها"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+_now_cache = [0, ""]  # (الثانية، النص المنسق)
+
+def _now_str() -> str:
+    """الوقت المحلي '%Y-%m-%d %H:%M:%S' (يُنسق مرة واحدة لكل ثانية)"""
+    t = int(time.time())
+    if t != _now_cache[0]:
+        _now_cache[0] = t
+        _now_cache[1] = datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+    return _now_cache[1]
+
+# عدد التحديثات التي يعالجها البوت في نفس الوقت
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+# عدد رسائل الإذاعة المرسلة في نفس الوقت
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "30"))
+BROADCAST_BATCH_SIZE = 512
+
+# علامة رسائل الإذاعة (تُستخدم في الإرسال وفي التعرف على الردود)
+BROADCAST_MARKER = "إذاعة من الإدارة:"
+BROADCAST_PREFIX = f"📢 **{BROADCAST_MARKER}**\n\n"
+
+def _compute_system_stats() -> dict:
+    stats = ai_manager.get_system_stats()
+    # عدد المزودين النشطين يُحسب مرة واحدة لكل تحديث للكاش
+    stats["active_provider_count"] = sum(
+        1 for p in stats.get("providers", {}).values() if p.get("enabled")
+    )
+    return stats
+
+# روابط ملفات تيليجرام حسب file_unique_id (إعادة /video على نفس الصورة)
+# الرابط صالح لساعة على الأقل، نحتفظ به 5 دقائق
+_file_path_cache = TTLCache(max_size=1024, ttl=300.0)
+
+# عدد المستخدمين للوحات المشرفين (يُبطل عند /start)
+USERS_COUNT_TTL = 30.0
+
+async def cached_users_count() -> int:
+    """عدد المستخدمين المسجلين (مخزن لـ 30 ثانية)"""
+    now = time.monotonic()
+    entry = _stats_cache.get("users_count")
+    if entry is not None and now - entry[0] < USERS_COUNT_TTL:
+        return entry[1]
+    count = await asyncio.to_thread(db.get_users_count)
+    _stats_cache["users_count"] = (now, count)
+    return count
+
+def cached_system_stats() -> dict:
+    """إحصائيات النظام (مخزنة لثوانٍ قليلة)"""
+    return _cached_stat("system", _compute_system_stats)
+
+def cached_available_services() -> dict:
+    """حالة الخدمات (مخزنة لثوانٍ قليلة)"""
+    return _cached_stat("services", ai_manager.get_available_services)
+
+# ==================== طابور مهام الذكاء الاصطناعي ====================
+# المعالجات تضع المهمة في الطابور وتعود فوراً، وعمال خلفيون ينفذون
+# طلبات المزودين البطيئة (ثوانٍ إلى دقائق) دون حجز معالجة التحديثات.
+# لكل نوع مهمة طابور وعمال خاصون، فلا تحجز طلبات الفيديو الطويلة ردود المحادثة
+AI_POOLS = {
+    "chat": (int(os.getenv("AI_CHAT_WORKERS", "8")), ChatAction.TYPING),
+    "image": (int(os.getenv("AI_IMAGE_WORKERS", "4")), ChatAction.UPLOAD_PHOTO),
+    "video": (int(os.getenv("AI_VIDEO_WORKERS", "2")), ChatAction.UPLOAD_VIDEO),
+}
+_ai_queues = {}  # نوع المهمة -> asyncio.Queue من (update, job)، تُنشأ عند بدء التشغيل
+_ai_workers = []
+
+async def _ai_worker(queue: asyncio.Queue):
+    """عامل خلفي ينفذ مهام الذكاء الاصطناعي من طابور نوعه"""
+    while True:
+        _, job = await queue.get()
+        try:
+            await job
+        except Exception as e:
+            logger.error(f"❌ AI task error: {e}")
+        finally:
+            queue.task_done()
+
+async def enqueue_ai_task(update: Update, job, kind: str = "chat"):
+    """إظهار مؤشر النشاط ثم وضع المهمة في طابور نوعها"""
+    queue = _ai_queues.get(kind)
+    if queue is None:
+        # العمال غير مشغلين (تشغيل خارج Application) - تنفيذ مباشر
+        await job
+        return
+    
+    try:
+        await update.message.chat.send_action(AI_POOLS[kind][1])
+    except Exception:
+        pass
+    await queue.put((update, job))
+
+async def start_ai_workers(application):
+    """تشغيل عمال الطوابير مع بدء البوت"""
+    for kind, (workers, _) in AI_POOLS.items():
+        queue = _ai_queues[kind] = asyncio.Queue()
+        for _ in range(workers):
+            _ai_workers.append(asyncio.create_task(_ai_worker(queue)))
+    logger.info(
+        "⚙️ عمال مهام الذكاء الاصطناعي: "
+        + "، ".join(f"{kind}={workers}" for kind, (workers, _) in AI_POOLS.items())
+    )
+
+async def stop_ai_workers():
+    """إيقاف العمال وإبلاغ أصحاب المهام المتبقية في الطوابير"""
+    for worker in _ai_workers:
+        worker.cancel()
+    await asyncio.gather(*_ai_workers, return_exceptions=True)
+    _ai_workers.clear()
+    
+    dropped = []
+    for queue in _ai_queues.values():
+        while not queue.empty():
+            update, job = queue.get_nowait()
+            job.close()
+            dropped.append(update)
+    _ai_queues.clear()
+    
+    if dropped:
+        logger.warning(f"⚠️ تم إلغاء {len(dropped)} مهمة ذكاء اصطناعي عند الإيقاف")
+        await asyncio.gather(
+            *(update.message.reply_text("⚠️ تم إيقاف البوت قبل تنفيذ طلبك، يرجى إعادة إرساله بعد قليل.")
+              for update in dropped),
+            return_exceptions=True
+        )
+
+def check_environment():
+    """فحص بيئة التشغيل (سطر سجل واحد)"""
+    logger.info(
+        "🔍 البيئة: BOT_TOKEN=%s GOOGLE_AI_API_KEY=%s admins=%d python=%s system=%s",
+        "✅" if os.getenv("BOT_TOKEN") else "❌",
+        "✅" if os.getenv("GOOGLE_AI_API_KEY") else "❌",
+        len(ADMIN_IDS),
+        sys.version.split()[0],
+        sys.platform
+    )
+
+# استدعاء الفحص عند البدء
+check_environment()
+
+# ==================== أوامر البوت الأساسية ====================
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    
+    # تسجيل المستخدم في قاعدة البيانات
+    await asyncio.to_thread(
+        db.add_or_update_user,
+        user_id=user.id,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name
+    )
+    _stats_cache.pop("users_count", None)
+    
+    # الحصول على حالة النظام
+    system_stats = cached_system_stats()
+    provider_count = system_stats.get("active_provider_count", 0)
+    
+    # إرسال إشعار ترحيبي
+    await update.message.reply_text(
+        f"🤖 **مرحباً {user.first_name}!**\n\n"
+        f"أنا بوت الذكاء الاصطناعي الذكي المتعدد المصادر! 🚀\n\n"
+        f"🎯 **ما يمكنني فعله:**\n"
+        f"💬 محادثة ذكية مع {provider_count} مزود\n"
+        f"🎨 إنشاء صور احترافية من الوصف\n"
+        f"🎬 إنشاء فيديوهات متحركة متقدمة\n"
+        f"📊 إحصائيات استخدام ذكية\n\n"
+        f"🔍 **معرفك:** {user.id}\n"
+        f"✅ **تم التسجيل بنجاح**\n\n"
+        f"📝 استخدم /help لعرض جميع الأوامر\n"
+        f"🤖 جرب /chat للبدء في المحادثة\n"
+        f"🔧 استخدم /system لرؤية حالة النظام",
+        parse_mode='Markdown'
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض جميع الأوامر"""
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
+
+async def system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض حالة النظام الذكي والمزودين"""
+    try:
+        # الحصول على إحصائيات النظام
+        system_stats = cached_system_stats()
+        services = cached_available_services()
+        
+        parts = ["⚙️ **حالة النظام الذكي المتعدد المصادر**\n\n"]
+        
+        # حالة الخدمات
+        parts.append("📊 **الخدمات المتاحة:**\n")
+        parts.append(f"💬 المحادثة: {'✅ متاحة' if services.get('chat') else '❌ غير متاحة'}\n")
+        parts.append(f"🎨 إنشاء الصور: {'✅ متاحة' if services.get('image_generation') else '❌ غير متاحة'}\n")
+        parts.append(f"🎬 إنشاء الفيديوهات: {'✅ متاحة' if services.get('video_generation') else '❌ غير متاحة'}\n\n")
+        
+        # المزودين النشطين
+        parts.append("🔧 **المزودون النشطون:**\n")
+        
+        for provider_name, provider_info in system_stats.get("providers", {}).items():
+            if provider_info.get("enabled"):
+                parts.append(f"• {provider_name.upper()}: {provider_info.get('usage_today', 0)} طلب\n")
+        
+        parts.append("\n")
+        
+        # إحصائيات اليوم
+        parts.append(f"📈 **إحصائيات اليوم:**\n")
+        parts.append(f"📤 الطلبات: {system_stats.get('total_requests_today', 0)}\n")
+        parts.append(f"❌ الأخطاء: {system_stats.get('total_errors_today', 0)}\n")
+        parts.append(f"🔄 المزودون: {system_stats.get('active_provider_count', 0)}/{len(system_stats.get('providers', {}))}\n\n")
+        
+        # حالة قاعدة البيانات
+        db_status = await asyncio.to_thread(check_database_status)
+        parts.append(f"💾 **قاعدة البيانات:** {db_status.get('users_count', 0)} مستخدم\n\n")
+        
+        # معلومات النظام
+        parts.append("🕒 **معلومات النظام:**\n")
+        parts.append(f"⏰ الوقت: {_now_str()}\n")
+        parts.append(f"👑 المشرفين: {len(ADMIN_IDS)}\n")
+        parts.append(f"🚀 المنصة: Railway\n")
+        parts.append(f"🔄 الاكتشاف: {'✅ مكتمل' if system_stats.get('discovery_completed') else '⏳ قيد العمل'}\n\n")
+        
+        parts.append("✨ **النظام يعمل بشكل ذكي ومستقر**")
+        
+        await update.message.reply_text("".join(parts), parse_mode='Markdown')
+        
+    except Exception as e:
+        logger.error(f"❌ خطأ في أمر النظام: {e}")
+        await update.message.reply_text("✅ النظام يعمل، لكن هناك تأخير في جلب التفاصيل.")
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض حالة البوت (للتوافق)"""
+    await system_command(update, context)
+
+async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض معلومات عن البوت"""
+    await update.message.reply_text(ABOUT_TEXT, parse_mode='Markdown')
+
+async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض حدود الاستخدام اليومية"""
+    await update.message.reply_text(LIMITS_TEXT, parse_mode='Markdown')
 
 # ==================== أوامر الذكاء الاصطناعي ====================
 
 async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """بدء محادثة مع الذكاء الاصطناعي (النسخة الذكية)"""
+    await enqueue_ai_task(update, _run_chat_command(update, context))
+
+async def _run_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_message = ' '.join(context.args) if context.args else ""
     
     if not user_message:
-        await update.message.reply_text(
-            "💬 **المحادثة الذكية**\n\n"
-            "اكتب رسالتك بعد الأمر:\n"
-            "`/chat مرحبا، كيف حالك؟`\n\n"
-            "✨ **المميزات:**\n"
-            "• يستخدم Google Gemini أولاً\n"
-            "• يتبدل لـ OpenAI تلقائياً\n"
-            "• يحفظ سياق المحادثة",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(CHAT_USAGE_TEXT, parse_mode='Markdown')
         return
     
     # إظهار رسالة "جاري المعالجة"
@@ -307,47 +537,27 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "جرب مرة أخرى بعد قليل."
         )
     finally:
-        # حذف رسالة الانتظار
+        # حذف رسالة الانتظار في الخلفية
         if processing_msg:
-            try:
-                await processing_msg.delete()
-            except:
-                pass
+            _fire_and_forget(processing_msg.delete())
 
 async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إنشاء صورة باستخدام النظام الذكي"""
+    await enqueue_ai_task(update, _run_image_command(update, context), "image")
+
+async def _run_image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if not context.args:
-        await update.message.reply_text(
-            "🎨 **إنشاء صور ذكية**\n\n"
-            "**الاستخدام:** `/image <وصف الصورة> [النمط]`\n\n"
-            "**أمثلة:**\n"
-            "`/image قطة لطيفة تجلس على كرسي`\n"
-            "`/image منظر لغروب الشمس realistic`\n"
-            "`/image ساحر في غابة سحرية fantasy`\n\n"
-            "**الأنماط المتاحة:**\n"
-            "`realistic` - واقعي (افتراضي)\n"
-            "`anime` - أنمي / كرتون\n"
-            "`fantasy` - فنتازيا سحرية\n"
-            "`cyberpunk` - مستقبلي تكنولوجي\n"
-            "`watercolor` - ألوان مائية\n\n"
-            "⚡ **النظام الذكي:**\n"
-            "• يستخدم DALL-E 3 أولاً\n"
-            "• يتبدل للبدائل تلقائياً\n"
-            "• يحسن الوصف أوتوماتيكياً\n"
-            "⏳ **المدة:** 10-30 ثانية",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(IMAGE_USAGE_TEXT, parse_mode='Markdown')
         return
     
     # استخراج النمط (آخر كلمة)
     args = context.args
-    prompt_words = args[:-1]
-    style = args[-1] if args[-1] in ["realistic", "anime", "fantasy", "cyberpunk", "watercolor"] else "realistic"
-    
-    if style != args[-1]:
-        prompt_words = args  # إذا لم يكن النمط، كل الكلمات للوصف
+    if args[-1] in VALID_STYLES:
+        style, prompt_words = args[-1], args[:-1]
+    else:
+        style, prompt_words = "realistic", args  # إذا لم يكن النمط، كل الكلمات للوصف
     
     prompt = ' '.join(prompt_words)
     
@@ -394,9 +604,6 @@ async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"3. انتظر قليلاً وجرب مرة أخرى"
             )
         
-        # حذف رسالة الانتظار
-        await wait_msg.delete()
-        
     except Exception as e:
         logger.error(f"❌ Image command error: {e}")
         await update.message.reply_text(
@@ -404,37 +611,19 @@ async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "النظام يحاول إصلاح نفسه تلقائياً...\n"
             "جرب مرة أخرى بعد دقيقة."
         )
-        
-        # محاولة حذف رسالة الانتظار
-        try:
-            await wait_msg.delete()
-        except:
-            pass
+    finally:
+        # حذف رسالة الانتظار في الخلفية
+        _fire_and_forget(wait_msg.delete())
 
 async def video_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إنشاء فيديو باستخدام النظام الذكي"""
+    await enqueue_ai_task(update, _run_video_command(update, context), "video")
+
+async def _run_video_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if not context.args:
-        await update.message.reply_text(
-            "🎬 **إنشاء فيديو ذكي**\n\n"
-            "**طريقتان للاستخدام:**\n\n"
-            "1. **من النص:**\n"
-            "`/video منظر طبيعي لغروب الشمس`\n\n"
-            "2. **من صورة:**\n"
-            "• أرسل صورة أولاً\n"
-            "• ثم رد عليها بالأمر:\n"
-            "`/video إضافة حركة للصورة`\n\n"
-            "**أمثلة:**\n"
-            "`/video مدينة المستقبل بإضاءة نيون`\n"
-            "`/video بحر هائج بأمواج عالية`\n\n"
-            "⚡ **النظام الذكي:**\n"
-            "• يستخدم Luma AI أولاً\n"
-            "• يتبدل للبدائل تلقائياً\n"
-            "• يحسن الوصف سينمائياً\n"
-            "⚠️ **المدة:** 2-5 دقائق",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(VIDEO_USAGE_TEXT, parse_mode='Markdown')
         return
     
     prompt = ' '.join(context.args)
@@ -445,10 +634,14 @@ async def video_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # التحقق إذا كان رداً على صورة
     image_url = None
-    if update.message.reply_to_message and update.message.reply_to_message.photo:
-        photo = update.message.reply_to_message.photo[-1]
-        image_file = await photo.get_file()
-        image_url = image_file.file_path
+    reply_to = update.message.reply_to_message
+    if reply_to and reply_to.photo:
+        photo = reply_to.photo[-1]
+        image_url = _file_path_cache.get(photo.file_unique_id)
+        if image_url is None:
+            image_file = await photo.get_file()
+            image_url = image_file.file_path
+            _file_path_cache[photo.file_unique_id] = image_url
     
     wait_msg = await update.message.reply_text(
         "🎬 **جاري إنشاء الفيديو...**\n"
@@ -488,8 +681,6 @@ async def video_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"3. انتظر 5 دقائق وجرب مرة أخرى"
             )
         
-        await wait_msg.delete()
-        
     except Exception as e:
         logger.error(f"❌ Video command error: {e}")
         await update.message.reply_text(
@@ -497,51 +688,35 @@ async def video_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "خدمة الفيديو قد تكون مشغولة حالياً...\n"
             "النظام يحاول مزوداً آخر تلقائياً."
         )
-        
-        try:
-            await wait_msg.delete()
-        except:
-            pass
+    finally:
+        # حذف رسالة الانتظار في الخلفية
+        _fire_and_forget(wait_msg.delete())
 
 async def my_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إحصائيات استخدامي مع معلومات النظام الذكي"""
     user_id = update.effective_user.id
     
     stats = ai_manager.get_user_stats(user_id)
-    services = ai_manager.get_available_services()
-    system_stats = ai_manager.get_system_stats()
+    services = cached_available_services()
+    system_stats = cached_system_stats()
     
-    # الحصول على معلومات المستخدم
-    user_info = db.get_user(user_id)
+    # الحصول على معلومات المستخدم (قراءة SQLite خارج حلقة الأحداث)
+    user_info = await asyncio.to_thread(db.get_user, user_id)
     username = user_info['first_name'] if user_info else "مستخدم"
     
     stats_text = f"📊 **إحصائيات {username}**\n\n"
     stats_text += f"🆔 المعرف: {user_id}\n"
-    stats_text += f"📅 اليوم: {datetime.now().strftime('%Y-%m-%d')}\n\n"
-    
-    limits = {
-        "ai_chat": int(os.getenv("DAILY_AI_LIMIT", "20")),
-        "image_gen": int(os.getenv("DAILY_IMAGE_LIMIT", "5")),
-        "video_gen": int(os.getenv("DAILY_VIDEO_LIMIT", "2"))
-    }
+    stats_text += f"📅 اليوم: {_now_str()[:10]}\n\n"
     
     # شريط التقدم للخدمات
-    for service, limit in limits.items():
+    for service, limit in DAILY_LIMITS.items():
         used = stats.get(service, 0)
         remaining = max(0, limit - used)
-        percentage = (used / limit * 100) if limit > 0 else 0
-        
-        service_names = {
-            "ai_chat": "💬 المحادثات",
-            "image_gen": "🎨 الصور المولدة",
-            "video_gen": "🎬 الفيديوهات"
-        }
         
-        # شريط تقدم مرئي
-        filled_blocks = int(percentage / 10)
-        progress_bar = "🟩" * filled_blocks + "⬜" * (10 - filled_blocks)
+        # شريط تقدم مرئي (حساب صحيح بدون أعداد عشرية)
+        progress_bar = PROGRESS_BARS[min(10, used * 10 // limit) if limit > 0 else 0]
         
-        stats_text += f"{service_names.get(service, service)}:\n"
+        stats_text += f"{USAGE_SERVICE_NAMES.get(service, service)}:\n"
         stats_text += f"{progress_bar}\n"
         stats_text += f"📊 {used}/{limit} ({remaining} متبقي)\n\n"
     
@@ -551,23 +726,19 @@ async def my_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # حالة الخدمات
     for service, available in services.items():
         status = "✅" if available else "❌"
-        service_name = {
-            "chat": "💬 المحادثة",
-            "image_generation": "🎨 إنشاء صور",
-            "video_generation": "🎬 إنشاء فيديوهات"
-        }.get(service, service)
+        service_name = SERVICE_STATUS_NAMES.get(service, service)
         
         stats_text += f"{status} {service_name}\n"
     
     # عدد المزودين النشطين
-    active_providers = len([p for p in system_stats.get("providers", {}).values() if p.get("enabled")])
+    active_providers = system_stats.get("active_provider_count", 0)
     stats_text += f"🔧 المزودون النشطون: {active_providers}\n"
     
     # إجمالي الطلبات اليوم
     total_requests = system_stats.get("total_requests_today", 0)
     stats_text += f"📤 إجمالي الطلبات اليوم: {total_requests}\n\n"
     
-    stats_text += "🔄 **التجديد:** تلقائي عند منتصف الليل (UTC)\n"
+    stats_text += "🔄 **التجديد:** تلقائي عند منتصف الليل (توقيت الخادم)\n"
     stats_text += "✨ **النظام يعمل بشكل ذكي ومستقر**"
     
     await update.message.reply_text(stats_text, parse_mode='Markdown')
@@ -576,55 +747,60 @@ async def my_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_ai_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة المحادثات العادية مع النظام الذكي"""
-    user_id = update.effective_user.id
-    user_message = update.message.text
+    message = update.message
+    user_message = message.text
     
     # تجاهل الأوامر
     if user_message.startswith('/'):
         return
     
+    user_id = update.effective_user.id
+    
     # التحقق من نوع الرسالة (رد على البوت أو رسالة مباشرة)
+    reply_to = message.reply_to_message
     is_reply_to_ai = (
-        update.message.reply_to_message and 
-        update.message.reply_to_message.from_user.id == context.bot.id
+        reply_to is not None and
+        reply_to.from_user is not None and
+        reply_to.from_user.id == context.bot.id
     )
-    is_direct_chat = not update.message.reply_to_message
+    is_direct_chat = reply_to is None
     
     if is_reply_to_ai or is_direct_chat:
-        # إظهار رسالة المعالجة
-        processing_msg = await update.message.reply_text(
-            "🤔 **جاري التفكير...**\n"
-            "⚡ النظام الذكي يعالج طلبك"
-        )
+        await enqueue_ai_task(update, _answer_conversation(update, user_id, user_message))
+
+async def _answer_conversation(update: Update, user_id: int, user_message: str):
+    """الرد على رسالة محادثة عادية (يُنفذ في عامل الطابور)"""
+    # إظهار رسالة المعالجة
+    processing_msg = await update.message.reply_text(
+        "🤔 **جاري التفكير...**\n"
+        "⚡ النظام الذكي يعالج طلبك"
+    )
+    
+    try:
+        # استخدام النظام الذكي
+        response = await ai_manager.chat_with_ai(user_id, user_message)
         
-        try:
-            # استخدام النظام الذكي
-            response = await ai_manager.chat_with_ai(user_id, user_message)
-            
-            reply_text = f"🤖 **المساعد الذكي:**\n\n{response}"
+        reply_text = f"🤖 **المساعد الذكي:**\n\n{response}"
+        
+        # تقسيم الرسائل الطويلة
+        if len(reply_text) > 4000:
+            for i in range(0, len(reply_text), 4000):
+                await update.message.reply_text(reply_text[i:i+4000], parse_mode='Markdown')
+        else:
+            await update.message.reply_text(reply_text, parse_mode='Markdown')
             
-            # تقسيم الرسائل الطويلة
-            if len(reply_text) > 4000:
-                parts = [reply_text[i:i+4000] for i in range(0, len(reply_text), 4000)]
-                for part in parts:
-                    await update.message.reply_text(part, parse_mode='Markdown')
-            else:
-                await update.message.reply_text(reply_text, parse_mode='Markdown')
-                
-        except Exception as e:
-            logger.error(f"❌ AI conversation error: {e}")
-            await update.message.reply_text(
-                "⚠️ **الخدمة مشغولة حالياً**\n\n"
-                "النظام يحاول مزوداً آخر تلقائياً...\n"
-                "يرجى المحاولة لاحقاً."
-            )
-        finally:
-            # حذف رسالة الانتظار
-            if processing_msg:
-                try:
-                    await processing_msg.delete()
-                except:
-                    pass
+    except Exception as e:
+        logger.error(f"❌ AI conversation error: {e}")
+        await update.message.reply_text(
+            "⚠️ **الخدمة مشغولة حالياً**\n\n"
+            "النظام يحاول مزوداً آخر تلقائياً...\n"
+            "يرجى المحاولة لاحقاً."
+        )
+    finally:
+        # حذف رسالة الانتظار في الخلفية
+        if processing_msg:
+            _fire_and_forget(processing_msg.delete())
+
 
 # ==================== أوامر المشرفين ====================
 
@@ -636,9 +812,9 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"محاولة وصول غير مصرح: المستخدم {user_id} حاول استخدام /admin")
         return
     
-    users_count = db.get_users_count()
-    system_stats = ai_manager.get_system_stats()
-    active_providers = len([p for p in system_stats.get("providers", {}).values() if p.get("enabled")])
+    users_count = await cached_users_count()
+    system_stats = cached_system_stats()
+    active_providers = system_stats.get("active_provider_count", 0)
     
     admin_commands = f"""
 👑 **لوحة تحكم المشرفين (النظام الذكي)**
@@ -685,11 +861,11 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"📊 المشرف {user_id} طلب الإحصائيات")
         
         # إحصائيات النظام
-        stats = db.get_stats_fixed()
-        system_stats = ai_manager.get_system_stats()
+        stats = await asyncio.to_thread(db.get_stats_fixed)
+        system_stats = cached_system_stats()
         
         # بناء رسالة الإحصائيات
-        stats_text = f"""
+        parts = [f"""
 📊 **إحصائيات النظام الكاملة (النظام الذكي)**
 
 👥 **المستخدمون:**
@@ -698,64 +874,46 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 💬 الرسائل الكلية: {stats.get('total_messages', 0):,}
 
 🤖 **النظام الذكي:**
-🔧 مزودون نشطون: {len([p for p in system_stats.get("providers", {}).values() if p.get("enabled")])}
+🔧 مزودون نشطون: {system_stats.get('active_provider_count', 0)}
 📤 طلبات اليوم: {system_stats.get('total_requests_today', 0):,}
 ❌ أخطاء اليوم: {system_stats.get('total_errors_today', 0):,}
 
-📊 **إحصائيات الذكاء الاصطناعي:"""
+📊 **إحصائيات الذكاء الاصطناعي:"""]
         
-        # إحصائيات AI من قاعدة البيانات
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute("SELECT COUNT(DISTINCT user_id) FROM ai_usage")
-                ai_users = cursor.fetchone()[0] or 0
-                
-                cursor.execute("SELECT SUM(usage_count) FROM ai_usage WHERE service_type = 'ai_chat'")
-                total_chats = cursor.fetchone()[0] or 0
-                
-                cursor.execute("SELECT SUM(usage_count) FROM ai_usage WHERE service_type = 'image_gen'")
-                total_images = cursor.fetchone()[0] or 0
-                
-                cursor.execute("SELECT SUM(usage_count) FROM ai_usage WHERE service_type = 'video_gen'")
-                total_videos = cursor.fetchone()[0] or 0
-                
-                stats_text += f"""
+        # إحصائيات AI من قاعدة البيانات (استعلام واحد في thread)
+        ai_users, total_chats, total_images, total_videos = await asyncio.to_thread(db.get_ai_usage_totals)
+        parts.append(f"""
 👤 مستخدمون AI: {ai_users}
 💬 محادثات: {total_chats:,}
 🎨 صور مولدة: {total_images:,}
 🎬 فيديوهات: {total_videos:,}
-"""
-                
-        except Exception as e:
-            logger.error(f"❌ خطأ في إحصائيات AI: {e}")
+""")
         
-        stats_text += f"""
+        parts.append(f"""
 📢 **الإذاعات:**
 📤 عدد الإذاعات: {stats.get('total_broadcasts', 0)}
-"""
+""")
         
         if stats.get('last_broadcast_id'):
-            stats_text += f"📅 آخر إذاعة: #{stats['last_broadcast_id']}\n"
+            parts.append(f"📅 آخر إذاعة: #{stats['last_broadcast_id']}\n")
         
         # المستخدمين الأكثر نشاطاً
         if stats.get('top_users') and len(stats['top_users']) > 0:
-            stats_text += "\n🏆 **المستخدمون الأكثر نشاطاً:**\n"
+            parts.append("\n🏆 **المستخدمون الأكثر نشاطاً:**\n")
             for i, user in enumerate(stats['top_users'][:5], 1):
                 name = user.get('first_name', 'مستخدم')
                 messages = user.get('message_count', 0)
-                stats_text += f"{i}. {name} - {messages:,} رسالة\n"
+                parts.append(f"{i}. {name} - {messages:,} رسالة\n")
         
         # معلومات النظام الذكي
-        stats_text += f"""
+        parts.append(f"""
 ⚙️ **معلومات النظام الذكي:**
 👑 المشرفين: {len(ADMIN_IDS)}
-🕒 آخر تحديث: {datetime.now().strftime('%H:%M:%S')}
+🕒 آخر تحديث: {_now_str()[11:]}
 🚀 الاكتشاف: {'✅ مكتمل' if system_stats.get('discovery_completed') else '⏳ جاري'}
-"""
+""")
         
-        await update.message.reply_text(stats_text, parse_mode='Markdown')
+        await update.message.reply_text("".join(parts), parse_mode='Markdown')
         logger.info(f"✅ تم عرض الإحصائيات الكاملة للمشرف {user_id}")
         
     except Exception as e:
@@ -771,36 +929,37 @@ async def providers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        system_stats = ai_manager.get_system_stats()
+        system_stats = cached_system_stats()
         
-        providers_text = "🔧 **حالة جميع المزودين:**\n\n"
+        parts = ["🔧 **حالة جميع المزودين:**\n\n"]
         
         for provider_name, provider_info in system_stats.get("providers", {}).items():
-            status = "✅" if provider_info.get("enabled") else "❌"
-            usage = provider_info.get("usage_today", 0)
-            limit = provider_info.get("daily_limit", 100)
-            errors = provider_info.get("errors_today", 0)
-            last_error = provider_info.get("last_error", "لا يوجد")
+            get = provider_info.get
+            errors = get("errors_today", 0)
+            models = get("active_models")
             
-            providers_text += f"{status} **{provider_name.upper()}:**\n"
-            providers_text += f"   📊 الاستخدام: {usage}/{limit}\n"
-            providers_text += f"   ❌ الأخطاء: {errors}\n"
+            parts.append(
+                f"{'✅' if get('enabled') else '❌'} **{provider_name.upper()}:**\n"
+                f"   📊 الاستخدام: {get('usage_today', 0)}/{get('daily_limit', 100)}\n"
+                f"   ❌ الأخطاء: {errors}\n"
+            )
             
-            if provider_info.get("active_models"):
-                providers_text += f"   🤖 الموديلات النشطة:\n"
-                for service, model in provider_info.get("active_models", {}).items():
-                    providers_text += f"      • {service}: {model}\n"
+            if models:
+                parts.append("   🤖 الموديلات النشطة:\n")
+                parts.extend(f"      • {service}: {model}\n" for service, model in models.items())
             
-            if errors > 0 and last_error != "لا يوجد":
-                providers_text += f"   ⚠️ آخر خطأ: {last_error[:50]}...\n"
+            if errors > 0:
+                last_error = get("last_error")
+                if last_error:
+                    parts.append(f"   ⚠️ آخر خطأ: {last_error[:50]}...\n")
             
-            providers_text += "\n"
+            parts.append("\n")
         
-        providers_text += f"🔄 **إجمالي الطلبات اليوم:** {system_stats.get('total_requests_today', 0)}\n"
-        providers_text += f"❌ **إجمالي الأخطاء اليوم:** {system_stats.get('total_errors_today', 0)}\n"
-        providers_text += f"⏰ **تاريخ الاكتشاف:** {system_stats.get('timestamp', 'غير معروف')[:19]}"
+        parts.append(f"🔄 **إجمالي الطلبات اليوم:** {system_stats.get('total_requests_today', 0)}\n")
+        parts.append(f"❌ **إجمالي الأخطاء اليوم:** {system_stats.get('total_errors_today', 0)}\n")
+        parts.append(f"⏰ **تاريخ الاكتشاف:** {system_stats.get('timestamp', 'غير معروف')[:19]}")
         
-        await update.message.reply_text(providers_text, parse_mode='Markdown')
+        await update.message.reply_text("".join(parts), parse_mode='Markdown')
         
     except Exception as e:
         logger.error(f"❌ خطأ في عرض المزودين: {e}")
@@ -820,6 +979,7 @@ async def reset_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         # إعادة تعيين كاش قاعدة البيانات
         ai_manager.user_limits_cache.clear()
+        _stats_cache.clear()
         
         await update.message.reply_text(
             "🔄 **تم إعادة تعيين الكاش بنجاح!**\n\n"
@@ -845,9 +1005,10 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ هذا الأمر للمشرفين فقط!")
         return
     
-    if update.message.reply_to_message:
-        message = update.message.reply_to_message.text or "رسالة ميديا"
-        users_count = db.get_users_count()
+    reply_to = update.message.reply_to_message
+    if reply_to:
+        message = reply_to.text or "رسالة ميديا"
+        users_count = await cached_users_count()
         
         await update.message.reply_text(
             f"📢 **رسالة الإذاعة:**\n"
@@ -885,76 +1046,92 @@ async def send_broadcast_command(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     message = context.user_data['pending_broadcast']
-    users = db.get_all_users()
-    users_count = len(users)
+    # المستهدفون = كل المستخدمين عدا المشرف المرسل
+    users_count = await asyncio.to_thread(db.get_users_count, user_id)
     
     if users_count == 0:
         await update.message.reply_text("❌ لا يوجد مستخدمين لإرسال الإذاعة لهم!")
         return
     
     # حفظ الإذاعة في قاعدة البيانات
-    broadcast_id = db.add_broadcast(user_id, message, users_count)
+    broadcast_id = await asyncio.to_thread(db.add_broadcast, user_id, message, users_count)
     
     if not broadcast_id:
         await update.message.reply_text("❌ فشل في حفظ الإذاعة!")
         return
     
-    # الإرسال الفعلي
-    sent_count = 0
-    failed_count = 0
-    failed_users = []
-    
     await update.message.reply_text(
         f"📤 جاري إرسال الإذاعة لـ {users_count} مستخدم...\n"
         f"⏳ قد يستغرق بعض الوقت..."
     )
     
-    for user in users:
-        user_id_in_db = user['user_id']
-        
-        try:
-            if user_id_in_db == user_id:
-                sent_count += 1
-                continue
-                
-            await context.bot.send_message(
-                chat_id=user['user_id'],
-                text=f"📢 **إذاعة من الإدارة:**\n\n{message}"
-            )
-            sent_count += 1
-            
-            db.log_activity(
-                user_id=user['user_id'],
-                action="broadcast_received",
-                details=f"broadcast_id={broadcast_id}"
-            )
-            
-            if sent_count % 10 == 0:
-                await asyncio.sleep(0.3)
-                
-        except Exception as e:
-            failed_count += 1
-            failed_users.append(user['user_id'])
-            logger.error(f"❌ فشل إرسال للإذاعة {broadcast_id} للمستخدم {user['user_id']}: {e}")
+    # حذف الرسالة المعلقة
+    del context.user_data['pending_broadcast']
     
-    # تحديث عدد المستلمين
+    # الإرسال في الخلفية حتى لا يبقى المعالج محجوزاً طوال مدة الإذاعة
+    broadcast_tasks = context.bot_data.setdefault('broadcast_tasks', {})
+    task = context.application.create_task(
+        _run_broadcast(context.bot, update.effective_chat.id, user_id, broadcast_id, message, users_count)
+    )
+    broadcast_tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: broadcast_tasks.pop(broadcast_id, None))
+
+async def _run_broadcast(bot, chat_id: int, admin_id: int, broadcast_id: int, message: str, users_count: int):
+    """إرسال الإذاعة للمستخدمين ثم إرسال التقرير للمشرف"""
+    # نص الإذاعة يُبنى مرة واحدة ويُرسل للجميع
+    broadcast_text = BROADCAST_PREFIX + message
+    send_sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    
+    async def _send_one(target_id: int):
+        # إرسال متزامن محدود العدد، والمعدل عبر AIORateLimiter في البوت
+        async with send_sem:
+            return await bot.send_message(chat_id=target_id, text=broadcast_text)
+    
+    # قراءة المستخدمين على دفعات بدلاً من تحميل الجدول كاملاً
+    received = []
+    failures = []
+    error = None
+    last_id = 0
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-            UPDATE broadcasts 
-            SET recipients_count = ?
-            WHERE broadcast_id = ?
-            ''', (sent_count, broadcast_id))
-            conn.commit()
+        while True:
+            batch = await asyncio.to_thread(db.get_user_ids_batch, last_id, BROADCAST_BATCH_SIZE, admin_id)
+            if not batch:
+                break
+            last_id = batch[-1]
+            
+            results = await asyncio.gather(*(_send_one(t) for t in batch), return_exceptions=True)
+            
+            batch_received = []
+            for target_id, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    failures.append((target_id, str(result)[:200]))
+                    logger.error(f"❌ فشل إرسال للإذاعة {broadcast_id} للمستخدم {target_id}: {result}")
+                else:
+                    batch_received.append((target_id, result.message_id))
+            
+            received.extend(batch_received)
+            # تسجيل رسائل الدفعة فوراً حتى تُعرف الردود عليها أثناء استمرار الإذاعة
+            await asyncio.to_thread(db.add_broadcast_messages, broadcast_id, batch_received)
     except Exception as e:
-        logger.error(f"❌ فشل تحديث عدد المستلمين: {e}")
+        error = e
+        logger.error(f"❌ توقفت الإذاعة #{broadcast_id} قبل اكتمالها: {e}")
+    finally:
+        # تسجيل الاستلام وعدد المستلمين الفعلي (حتى لو توقفت الإذاعة أو أُلغيت)
+        await asyncio.to_thread(db.complete_broadcast, broadcast_id, received, len(received), failures)
+    
+    sent_count = len(received)
+    failed_count = len(failures)
     
     # تقرير المشرف
     success_rate = (sent_count / users_count * 100) if users_count > 0 else 0
     
+    if error is None:
+        header = "✅ **تم إرسال الإذاعة بنجاح!**"
+    else:
+        header = f"⚠️ **توقفت الإذاعة قبل اكتمالها!**\n❗ السبب: {str(error)[:200]}"
+    
     report = f"""
-✅ **تم إرسال الإذاعة بنجاح!**
+{header}
 
 📊 **التقرير:**
 🆔 رقم الإذاعة: {broadcast_id}
@@ -964,15 +1141,22 @@ async def send_broadcast_command(update: Update, context: ContextTypes.DEFAULT_T
 📈 نسبة النجاح: {success_rate:.1f}%
 """
     
-    if failed_count > 0 and failed_users:
-        report += f"\n📛 **المستخدمين الذين فشل الإرسال لهم:**\n"
-        for failed_id in failed_users[:5]:
-            report += f"- {failed_id}\n"
-    
-    await update.message.reply_text(report, parse_mode='Markdown')
+    if failures:
+        report = "".join([
+            report,
+            "\n📛 **المستخدمين الذين فشل الإرسال لهم:**\n",
+            *(f"- {failed_id}\n" for failed_id, _ in failures[:5])
+        ])
     
-    # حذف الرسالة المعلقة
-    del context.user_data['pending_broadcast']
+    try:
+        await bot.send_message(chat_id=chat_id, text=report, parse_mode='Markdown')
+    except Exception as e:
+        # نص الخطأ قد يكسر تنسيق Markdown - إعادة الإرسال كنص عادي
+        logger.error(f"❌ فشل إرسال تقرير الإذاعة #{broadcast_id}: {e}")
+        try:
+            await bot.send_message(chat_id=chat_id, text=report)
+        except Exception as e:
+            logger.error(f"❌ فشل إرسال تقرير الإذاعة #{broadcast_id} كنص عادي: {e}")
 
 async def broadcast_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إحصائيات إذاعة محددة"""
@@ -984,7 +1168,7 @@ async def broadcast_stats_command(update: Update, context: ContextTypes.DEFAULT_
     
     if context.args and context.args[0].isdigit():
         broadcast_id = int(context.args[0])
-        stats = db.get_broadcast_stats(broadcast_id)
+        stats = await asyncio.to_thread(db.get_broadcast_stats, broadcast_id)
         
         if stats:
             stats_text = f"""
@@ -993,11 +1177,13 @@ async def broadcast_stats_command(update: Update, context: ContextTypes.DEFAULT_
 📝 **الرسالة:** {stats['message_text'][:100]}...
 
 👤 **المرسل:** المشرف {stats.get('admin_id', 'غير معروف')}
-📅 **تاريخ الإرسال:** {stats['sent_date'][:16]}
+📅 **تاريخ الإرسال:** {datetime.fromtimestamp(stats['sent_ts']).strftime('%Y-%m-%d %H:%M') if stats.get('sent_ts') else 'غير معروف'}
 
 📈 **الإحصائيات:**
 👥 العدد المستهدف: {stats['recipients_count']}
 """
+            if broadcast_id in context.bot_data.get('broadcast_tasks', {}):
+                stats_text += "⏳ **الحالة:** جاري الإرسال...\n"
             await update.message.reply_text(stats_text, parse_mode='Markdown')
         else:
             await update.message.reply_text(f"❌ لم يتم العثور على إذاعة برقم #{broadcast_id}")
@@ -1012,63 +1198,68 @@ async def users_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("⛔ هذا الأمر للمشرفين فقط!")
         return
     
-    users = db.get_all_users()
-    users_count = len(users)
+    # أول 10 مستخدمين فقط + العدد الكلي (بدون تحميل الجدول كاملاً)
+    display_users = await asyncio.to_thread(db.get_users_page, 10, 0)
+    users_count = await cached_users_count()
     
     if users_count == 0:
         await update.message.reply_text("📭 لا يوجد مستخدمين مسجلين بعد.")
         return
     
-    display_users = users[:10]
-    
-    users_text = f"👥 **المستخدمون المسجلون** ({users_count} مستخدم)\n\n"
+    parts = [f"👥 **المستخدمون المسجلون** ({users_count} مستخدم)\n\n"]
     
     for i, user in enumerate(display_users, 1):
-        users_text += f"{i}. {user['first_name']}"
+        parts.append(f"{i}. {user['first_name']}")
         if user['username']:
-            users_text += f" (@{user['username']})"
-        users_text += f" - ID: {user['user_id']}\n"
+            parts.append(f" (@{user['username']})")
+        parts.append(f" - ID: {user['user_id']}\n")
         join_date = user['join_date'][:10] if user['join_date'] else "غير معروف"
-        users_text += f"   📅 انضم: {join_date}\n"
-        users_text += f"   💬 رسائل: {user['message_count']}\n\n"
+        parts.append(f"   📅 انضم: {join_date}\n")
+        parts.append(f"   💬 رسائل: {user['message_count']}\n\n")
     
     if users_count > 10:
-        users_text += f"\n📋 عرض 10 من أصل {users_count} مستخدم\n"
-        users_text += "استخدم /userslist2 للصفحة التالية"
+        parts.append(f"\n📋 عرض 10 من أصل {users_count} مستخدم\n")
+        parts.append("استخدم /userslist2 للصفحة التالية")
     
-    await update.message.reply_text(users_text, parse_mode='Markdown')
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
     logger.info(f"المشرف {user_id} طلب قائمة المستخدمين")
 
 async def handle_broadcast_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """تتبع ردود المستخدمين على الإذاعات"""
-    if update.message.reply_to_message and update.message.reply_to_message.text:
-        replied_text = update.message.reply_to_message.text
-        if "إذاعة من الإدارة:" in replied_text:
-            user_id = update.effective_user.id
-            user = db.get_user(user_id)
-            
-            if user:
-                db.log_activity(
-                    user_id=user_id,
-                    action="broadcast_replied",
-                    details=f"reply: {update.message.text[:50]}"
-                )
-                
-                admin_message = f"""
+    # الفلتر يضمن أن الرسالة رد (filters.REPLY)
+    reply_to = update.message.reply_to_message
+    if not await asyncio.to_thread(db.is_broadcast_message, reply_to.chat_id, reply_to.message_id):
+        return
+    
+    # بيانات المستخدم موجودة في التحديث نفسه - لا حاجة لقراءة القاعدة
+    user = update.effective_user
+    user_id = user.id
+    reply = update.message.text
+    
+    # تسجيل النشاط في الخلفية
+    _fire_and_forget(asyncio.to_thread(
+        db.log_activity,
+        user_id=user_id,
+        action="broadcast_replied",
+        details=f"reply: {reply[:50]}"
+    ))
+    
+    admin_message = f"""
 🔄 **رد على إذاعة:**
-👤 المستخدم: {user['first_name']} (@{user['username'] or 'بدون'})
+👤 المستخدم: {user.first_name} (@{user.username or 'بدون'})
 🆔 المعرف: {user_id}
-💬 الرد: {update.message.text[:100]}
+💬 الرد: {reply[:100]}
 """
-                
-                for admin_id in ADMIN_IDS:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=admin_id,
-                            text=admin_message
-                        )
-                    except Exception as e:
-                        logger.error(f"فشل إرسال إشعار للمشرف {admin_id}: {e}")
+    
+    # إرسال متوازي لكل المشرفين (زمن أبطأ رد بدلاً من مجموعها)
+    admins = tuple(ADMIN_IDS)
+    results = await asyncio.gather(
+        *(context.bot.send_message(chat_id=admin_id, text=admin_message) for admin_id in admins),
+        return_exceptions=True
+    )
+    for admin_id, result in zip(admins, results):
+        if isinstance(result, Exception):
+            logger.error(f"فشل إرسال إشعار للمشرف {admin_id}: {result}")
 
 # ==================== وظائف مساعدة ====================
 def check_database_status():
@@ -1091,36 +1282,67 @@ def check_database_status():
         logger.error(f"❌ فشل في فحص حالة قاعدة البيانات: {e}")
         return {'error': str(e), 'last_check': datetime.now().isoformat()}
 
-def setup_handlers(application):
-    """إعداد معالجات الأوامر والرسائل"""
-    
+# جدول الأوامر: الاسم -> المعالج (بحث مباشر بدلاً من المرور على معالج لكل أمر)
+COMMANDS = {
     # الأوامر الأساسية
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("status", status_command))
-    application.add_handler(CommandHandler("system", system_command))
-    application.add_handler(CommandHandler("about", about_command))
-    application.add_handler(CommandHandler("limits", limits_command))
+    "start": start,
+    "help": help_command,
+    "status": status_command,
+    "system": system_command,
+    "about": about_command,
+    "limits": limits_command,
     
     # أوامر الذكاء الاصطناعي للمستخدمين
-    application.add_handler(CommandHandler("chat", chat_command))
-    application.add_handler(CommandHandler("ask", chat_command))
-    application.add_handler(CommandHandler("image", image_command))
-    application.add_handler(CommandHandler("draw", image_command))
-    application.add_handler(CommandHandler("video", video_command))
-    application.add_handler(CommandHandler("mystats", my_stats_command))
-    application.add_handler(CommandHandler("aistats", my_stats_command))
-    application.add_handler(CommandHandler("aihelp", help_command))
+    "chat": chat_command,
+    "ask": chat_command,
+    "image": image_command,
+    "draw": image_command,
+    "video": video_command,
+    "mystats": my_stats_command,
+    "aistats": my_stats_command,
+    "aihelp": help_command,
     
     # أوامر المشرفين
-    application.add_handler(CommandHandler("admin", admin_panel))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("providers", providers_command))
-    application.add_handler(CommandHandler("resetcache", reset_cache_command))
-    application.add_handler(CommandHandler("broadcast", broadcast_command))
-    application.add_handler(CommandHandler("sendbroadcast", send_broadcast_command))
-    application.add_handler(CommandHandler("broadcaststats", broadcast_stats_command))
-    application.add_handler(CommandHandler("userslist", users_list_command))
+    "admin": admin_panel,
+    "stats": stats_command,
+    "providers": providers_command,
+    "resetcache": reset_cache_command,
+    "broadcast": broadcast_command,
+    "sendbroadcast": send_broadcast_command,
+    "broadcaststats": broadcast_stats_command,
+    "userslist": users_list_command,
+}
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """توجيه الأمر إلى معالجه من جدول COMMANDS"""
+    message = update.effective_message
+    if not message or not message.text:
+        return
+    
+    first, *args = message.text.split()
+    command, _, target = first[1:].partition("@")
+    
+    # أمر موجه لبوت آخر في مجموعة
+    if target and target.lower() != (context.bot.username or "").lower():
+        return
+    
+    handler = COMMANDS.get(command.lower())
+    if handler is None:
+        return
+    
+    # نفس ما يوفره CommandHandler للمعالجات
+    context.args = args
+    await handler(update, context)
+
+def setup_handlers(application):
+    """إعداد معالجات الأوامر والرسائل"""
+    
+    # جميع الأوامر عبر معالج واحد وجدول COMMANDS
+    # الرسائل الجديدة فقط (المعالجات تستخدم update.message - لا منشورات قنوات ولا رسائل معدلة)
+    application.add_handler(MessageHandler(
+        filters.COMMAND & filters.UpdateType.MESSAGE,
+        dispatch_command
+    ))
     
     # معالج المحادثات العادية مع AI
     application.add_handler(MessageHandler(
@@ -1128,12 +1350,27 @@ def setup_handlers(application):
         handle_ai_conversation
     ), group=1)
     
-    # معالج للردود على الإذاعات
+    # معالج للردود على الإذاعات (الردود فقط - الرسائل الأخرى تُستبعد في الفلتر)
     application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
+        filters.TEXT & ~filters.COMMAND & filters.REPLY,
         handle_broadcast_reply
     ), group=2)
 
+async def on_startup(application):
+    """تهيئة الحالة المشتركة عند بدء البوت"""
+    await start_ai_workers(application)
+    ai_manager.start_daily_reset()
+
+async def on_stop(application):
+    """إيقاف عمال الطوابير (البوت ما زال متصلاً لإبلاغ أصحاب المهام الملغاة)"""
+    await stop_ai_workers()
+
+async def on_shutdown(application):
+    """إغلاق الموارد المشتركة عند إيقاف البوت"""
+    await ai_manager.close()
+    # بعد تفريغ الاستخدام: لا استدعاءات أخرى للقاعدة
+    db.close_connections()
+
 def run_bot():
     """تشغيل البوت"""
     BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -1142,7 +1379,34 @@ def run_bot():
         logger.error("❌ BOT_TOKEN غير معين")
         return
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    # حلقة أحداث أسرع (uvloop) إن كانت متاحة - لا تغيير في المعالجات
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("⚡ تم تفعيل uvloop")
+    except ImportError:
+        pass
+    
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # كل تحديث في مهمة مستقلة: أمر بطيء لمستخدم لا يؤخر بقية المستخدمين
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    
+    # محدد معدل تيليجرام المدمج: يحترم حدود الإرسال ويعيد المحاولة عند RetryAfter
+    # مطلوب - هو المحدد الوحيد لمعدل الإرسال (الإذاعة ترسل 30 رسالة متزامنة)
+    try:
+        builder.rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        logger.info("⏱️ تم تفعيل AIORateLimiter")
+    except RuntimeError:
+        logger.error("❌ AIORateLimiter غير متاح (ثبّت python-telegram-bot[rate-limiter])")
+        return
+    
+    application = builder.build()
     setup_handlers(application)
     
     logger.info(f"🤖 بدأ تشغيل بوت النظام الذكي المتعدد المصادر...")
@@ -1156,7 +1420,7 @@ def run_bot():
     logger.info(f"👥 عدد المستخدمين المسجلين: {users_count}")
     
     # ✅ فحص خدمات النظام الذكي
-    system_stats = ai_manager.get_system_stats()
+    system_stats = cached_system_stats()
     logger.info(f"🤖 النظام الذكي: {system_stats.get('total_requests_today', 0)} طلبات اليوم")
     
     application.run_polling(drop_pending_updates=True)
@@ -1,6 +1,7 @@
 # database.py - النسخة النهائية مع دعم الذكاء الاصطناعي
 import sqlite3
 import logging
+import threading
 from datetime import datetime, timedelta
 import os
 
@@ -10,14 +11,57 @@ class Database:
     def __init__(self, db_name="bot_database.db"):
         """تهيئة قاعدة البيانات"""
         self.db_name = db_name
+        self._wal_enabled = False
+        self._local = threading.local()
+        # كل الاتصالات المفتوحة (اتصال لكل خيط) لإغلاقها عند الإيقاف
+        self._connections = []
+        self._connections_lock = threading.Lock()
         self.init_database()
     
     def get_connection(self):
-        """الحصول على اتصال بقاعدة البيانات"""
-        conn = sqlite3.connect(self.db_name)
+        """
+        الحصول على اتصال بقاعدة البيانات
+        اتصال دائم لكل خيط (حلقة الأحداث وخيوط to_thread) بدلاً من اتصال جديد لكل استدعاء،
+        فتبقى الاستعلامات المحللة في ذاكرة الاتصال (cached_statements)
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        
+        # check_same_thread=False فقط ليتمكن close_connections من إغلاقه من خيط آخر؛
+        # أثناء التشغيل يستخدم كل خيط اتصاله فقط
+        conn = sqlite3.connect(self.db_name, timeout=5.0, cached_statements=512, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        
+        # WAL دائم في ملف القاعدة - يكفي تفعيله مع أول اتصال
+        # يسمح للقراءات بالاستمرار أثناء الكتابة (الإذاعات وسجل الاستخدام)
+        if not self._wal_enabled:
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._wal_enabled = True
+        
+        # إعدادات خاصة بكل اتصال
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
         return conn
     
+    def close_connections(self):
+        """إغلاق كل اتصالات الخيوط (عند إيقاف البوت) - الاستدعاء التالي يفتح اتصالاً جديداً"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"❌ خطأ في إغلاق اتصال قاعدة البيانات: {e}")
+        if connections:
+            logger.info(f"💾 تم إغلاق {len(connections)} اتصال بقاعدة البيانات")
+    
     def init_database(self):
         """إنشاء الجداول إذا لم تكن موجودة"""
         try:
@@ -45,7 +89,36 @@ class Database:
                     admin_id INTEGER,
                     message_text TEXT,
                     sent_date TEXT,
-                    recipients_count INTEGER
+                    recipients_count INTEGER,
+                    sent_ts INTEGER
+                )
+                ''')
+                
+                # ترحيل: وقت الإرسال كـ unix timestamp للقواعد القديمة
+                cursor.execute("PRAGMA table_info(broadcasts)")
+                if "sent_ts" not in {row[1] for row in cursor.fetchall()}:
+                    cursor.execute("ALTER TABLE broadcasts ADD COLUMN sent_ts INTEGER")
+                    cursor.execute(
+                        "UPDATE broadcasts SET sent_ts = CAST(strftime('%s', sent_date, 'utc') AS INTEGER)"
+                    )
+                
+                # رسائل الإذاعة المرسلة (للتعرف على الردود عليها)
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_messages (
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    broadcast_id INTEGER,
+                    PRIMARY KEY (chat_id, message_id)
+                )
+                ''')
+                
+                # المستخدمون الذين فشل إرسال الإذاعة لهم وسبب الفشل
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_failures (
+                    broadcast_id INTEGER,
+                    user_id INTEGER,
+                    error TEXT,
+                    PRIMARY KEY (broadcast_id, user_id)
                 )
                 ''')
                 
@@ -116,6 +189,20 @@ class Database:
                 )
                 ''')
                 
+                # ==================== الفهارس ====================
+                # الأعمدة المستخدمة في الترتيب والتصفية (broadcast_id و user_id مفاتيح أساسية أصلاً)
+                cursor.executescript('''
+                CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date);
+                CREATE INDEX IF NOT EXISTS idx_users_message_count ON users(message_count);
+                CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active);
+                CREATE INDEX IF NOT EXISTS idx_ai_usage_date ON ai_usage(usage_date);
+                CREATE INDEX IF NOT EXISTS idx_ai_conversations_user ON ai_conversations(user_id, timestamp);
+                CREATE INDEX IF NOT EXISTS idx_ai_conversations_timestamp ON ai_conversations(timestamp);
+                CREATE INDEX IF NOT EXISTS idx_ai_files_user ON ai_generated_files(user_id, created_at);
+                CREATE INDEX IF NOT EXISTS idx_activity_timestamp ON activity_logs(timestamp);
+                CREATE INDEX IF NOT EXISTS idx_broadcasts_ts ON broadcasts(sent_ts);
+                ''')
+                
                 conn.commit()
                 logger.info("✅ قاعدة البيانات جاهزة مع دعم الذكاء الاصطناعي")
                 
@@ -188,12 +275,41 @@ class Database:
             logger.error(f"❌ خطأ في جلب جميع المستخدمين: {e}")
             return []
     
-    def get_users_count(self):
+    def get_users_page(self, limit=10, offset=0):
+        """صفحة من المستخدمين (الأحدث أولاً) دون تحميل الجدول كاملاً"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT * FROM users ORDER BY join_date DESC LIMIT ? OFFSET ?",
+                    (limit, offset)
+                )
+                return [dict(user) for user in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب صفحة المستخدمين: {e}")
+            return []
+    
+    def get_user_ids_batch(self, after_id=0, limit=512, exclude_id=None):
+        """دفعة من معرفات المستخدمين بعد after_id (ترقيم عبر المفتاح الأساسي)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? AND user_id IS NOT ? "
+                    "ORDER BY user_id LIMIT ?",
+                    (after_id, exclude_id, limit)
+                )
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب دفعة المستخدمين: {e}")
+            return []
+    
+    def get_users_count(self, exclude_id=None):
         """الحصول على عدد المستخدمين - موثوق 100%"""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM users")
+                cursor.execute("SELECT COUNT(*) FROM users WHERE user_id IS NOT ?", (exclude_id,))
                 result = cursor.fetchone()
                 return result[0] if result else 0
         except Exception as e:
@@ -222,12 +338,12 @@ class Database:
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                current_time = datetime.now().isoformat()
+                now = datetime.now()
                 
                 cursor.execute('''
-                INSERT INTO broadcasts (admin_id, message_text, sent_date, recipients_count)
-                VALUES (?, ?, ?, ?)
-                ''', (admin_id, message_text, current_time, recipients_count))
+                INSERT INTO broadcasts (admin_id, message_text, sent_date, recipients_count, sent_ts)
+                VALUES (?, ?, ?, ?, ?)
+                ''', (admin_id, message_text, now.isoformat(), recipients_count, int(now.timestamp())))
                 
                 conn.commit()
                 broadcast_id = cursor.lastrowid
@@ -237,6 +353,69 @@ class Database:
             logger.error(f"❌ خطأ في تسجيل الإذاعة: {e}")
             return None
     
+    def complete_broadcast(self, broadcast_id, delivered, sent_count, failed=()):
+        """
+        تسجيل استلام الإذاعة وتحديث عدد المستلمين في معاملة واحدة
+        delivered: قائمة (user_id, message_id) للرسائل المرسلة بنجاح
+        failed: قائمة (user_id, error) للرسائل التي فشل إرسالها
+        """
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                current_time = datetime.now().isoformat()
+                details = f"broadcast_id={broadcast_id}"
+                
+                cursor.executemany('''
+                INSERT INTO activity_logs (user_id, action, timestamp, details)
+                VALUES (?, ?, ?, ?)
+                ''', [(uid, "broadcast_received", current_time, details) for uid, _ in delivered])
+                
+                cursor.executemany('''
+                INSERT OR REPLACE INTO broadcast_failures (broadcast_id, user_id, error)
+                VALUES (?, ?, ?)
+                ''', [(broadcast_id, uid, error) for uid, error in failed])
+                
+                cursor.execute('''
+                UPDATE broadcasts 
+                SET recipients_count = ?
+                WHERE broadcast_id = ?
+                ''', (sent_count, broadcast_id))
+                
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في إنهاء الإذاعة #{broadcast_id}: {e}")
+            return False
+    
+    def add_broadcast_messages(self, broadcast_id, delivered):
+        """تسجيل رسائل دفعة من الإذاعة (user_id, message_id) فور إرسالها"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                INSERT OR IGNORE INTO broadcast_messages (chat_id, message_id, broadcast_id)
+                VALUES (?, ?, ?)
+                ''', [(uid, mid, broadcast_id) for uid, mid in delivered])
+                conn.commit()
+                return True
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل رسائل الإذاعة #{broadcast_id}: {e}")
+            return False
+    
+    def is_broadcast_message(self, chat_id, message_id):
+        """هل الرسالة من رسائل الإذاعة؟ (بحث بالمفتاح الأساسي)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT 1 FROM broadcast_messages WHERE chat_id = ? AND message_id = ?",
+                    (chat_id, message_id)
+                )
+                return cursor.fetchone() is not None
+        except Exception as e:
+            logger.error(f"❌ خطأ في فحص رسالة الإذاعة: {e}")
+            return False
+    
     def get_broadcasts(self, limit=10):
         """الحصول على آخر الإذاعات"""
         try:
@@ -246,7 +425,7 @@ class Database:
                 SELECT b.*, u.first_name as admin_name 
                 FROM broadcasts b
                 LEFT JOIN users u ON b.admin_id = u.user_id
-                ORDER BY sent_date DESC
+                ORDER BY sent_ts DESC
                 LIMIT ?
                 ''', (limit,))
                 broadcasts = cursor.fetchall()
@@ -343,6 +522,34 @@ class Database:
             logger.error(f"❌ خطأ في جلب عدد مستخدمي AI: {e}")
             return 0
     
+    def get_ai_usage_totals(self):
+        """إجمالي استخدام الذكاء الاصطناعي (مستخدمون، محادثات، صور، فيديوهات) في مسح واحد للجدول"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT COUNT(DISTINCT user_id),
+                       SUM(CASE WHEN service_type = 'ai_chat' THEN usage_count ELSE 0 END),
+                       SUM(CASE WHEN service_type = 'image_gen' THEN usage_count ELSE 0 END),
+                       SUM(CASE WHEN service_type = 'video_gen' THEN usage_count ELSE 0 END)
+                FROM ai_usage
+                ''')
+                return tuple(x or 0 for x in cursor.fetchone())
+        except Exception as e:
+            logger.error(f"❌ خطأ في جلب إجمالي استخدام AI: {e}")
+            return (0, 0, 0, 0)
+    
+    def get_user_usage_count(self, user_id, service_type, usage_date):
+        """استخدام مستخدم لخدمة في يوم محدد"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT usage_count FROM ai_usage WHERE user_id = ? AND service_type = ? AND usage_date = ?',
+                (user_id, service_type, usage_date)
+            )
+            result = cursor.fetchone()
+            return result[0] if result else 0
+    
     def save_ai_conversation(self, user_id, service_type, user_message, ai_response):
         """حفظ محادثة الذكاء الاصطناعي"""
         try:
@@ -654,13 +861,17 @@ class Database:
     # ==================== دوال النسخ الاحتياطي ====================
     def backup_database(self, backup_name=None):
         """إنشاء نسخة احتياطية من قاعدة البيانات"""
-        import shutil
-        
         try:
             if backup_name is None:
                 backup_name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
             
-            shutil.copy2(self.db_name, backup_name)
+            # نسخ عبر SQLite نفسه: يشمل الصفحات التي ما زالت في ملف -wal
+            # (نسخ ملف .db مباشرة في وضع WAL يعطي نسخة قديمة أو غير متسقة)
+            target = sqlite3.connect(backup_name)
+            try:
+                self.get_connection().backup(target)
+            finally:
+                target.close()
             logger.info(f"✅ تم إنشاء نسخة احتياطية: {backup_name}")
             return backup_name
         except Exception as e: